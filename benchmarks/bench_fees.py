@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+""" Compare moneris_compute_fees called per line with moneris_compute_fees_batch. """
+
+import random
+
+from common import cursor, parse_args, timer
+
+
+def main():
+    args = parse_args(__doc__, lines=dict(type=int, default=10000, help='number of amounts'))
+    with cursor(args.database) as (registry, cr, uid):
+        Acquirer = registry['payment.acquirer']
+        acquirer_ids = Acquirer.search(cr, uid, [('provider', '=', 'moneris')], limit=1)
+        assert acquirer_ids, 'no Moneris acquirer in database %s' % args.database
+        acquirer_id = acquirer_ids[0]
+        Acquirer.write(cr, uid, acquirer_ids, {'fees_active': True})
+        country_ids = registry['res.country'].search(cr, uid, [])
+        amounts = [round(random.uniform(1, 1000), 2) for dummy in range(args.lines)]
+        countries = [random.choice(country_ids) for dummy in range(args.lines)]
+
+        with timer('scalar x %s' % args.lines, args.lines):
+            scalar = [Acquirer.moneris_compute_fees(cr, uid, acquirer_id, amount, None, country_id)
+                      for amount, country_id in zip(amounts, countries)]
+        with timer('batch x %s' % args.lines, args.lines):
+            batch = Acquirer.moneris_compute_fees_batch(cr, uid, acquirer_id, amounts, None, countries)
+        assert scalar == batch, 'batch fees differ from scalar fees'
+
+
+if __name__ == '__main__':
+    main()
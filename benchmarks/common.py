@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+""" Helpers shared by the benchmark scripts.
+
+The scripts run against an existing database with payment_moneris installed:
+
+    python benchmarks/bench_fees.py -c /etc/openerp-server.conf -d mydb
+"""
+
+import argparse
+import contextlib
+import time
+
+import openerp
+from openerp import api, SUPERUSER_ID
+
+
+def parse_args(description, **extra):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-c', '--config', help='server configuration file')
+    parser.add_argument('-d', '--database', required=True, help='database with payment_moneris installed')
+    for name, options in extra.items():
+        parser.add_argument('--%s' % name.replace('_', '-'), dest=name, **options)
+    args = parser.parse_args()
+    openerp.tools.config.parse_config(['-c', args.config] if args.config else [])
+    return args
+
+
+@contextlib.contextmanager
+def cursor(dbname):
+    """ Yield a cursor on ``dbname``; everything is rolled back at the end. """
+    registry = openerp.registry(dbname)
+    with api.Environment.manage():
+        cr = registry.cursor()
+        try:
+            yield registry, cr, SUPERUSER_ID
+        finally:
+            cr.rollback()
+            cr.close()
+
+
+@contextlib.contextmanager
+def timer(label, count=None):
+    start = time.time()
+    yield
+    duration = time.time() - start
+    if count:
+        print('%-40s %10.3fs  %10.1f/s' % (label, duration, count / duration if duration else float('inf')))
+    else:
+        print('%-40s %10.3fs' % (label, duration))
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+""" Local stand-in for the Moneris endpoints used by payment_moneris.
+
+Serves the Hosted Paypage (``/HPPDP/index.php``, ``/HPPDP/verifyTxn.php``)
+and the Rest API (``/v1/oauth2/token``, ``/v1/payments/payment``,
+``/v1/vault/credit-card``) with a
+configurable latency and error rate. Point the ``test`` environment of the
+acquirer to it with, in the server configuration file:
+
+    moneris_test_server = http://127.0.0.1:8765
+
+The server keeps no state: transaction keys are generated with
+``make_transaction_key`` and carry the order id and amount that
+verifyTxn.php reports back.
+"""
+
+import argparse
+import binascii
+import json
+import random
+import threading
+import time
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+
+def make_transaction_key(order_id, amount):
+    return binascii.hexlify('%s:%.2f' % (order_id, amount))
+
+
+def parse_transaction_key(key):
+    order_id, amount = binascii.unhexlify(key).rsplit(':', 1)
+    return order_id, amount
+
+
+class FakeMonerisHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def _reply(self, code, body, content_type='text/html'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _simulate(self):
+        """ Apply latency and random failures; return False if the request
+        was answered with an error. """
+        server = self.server
+        delay = server.latency + random.uniform(0, server.jitter)
+        if delay:
+            time.sleep(delay)
+        with server.lock:
+            server.requests += 1
+        if random.random() < server.error_rate:
+            with server.lock:
+                server.errors += 1
+            self._reply(503, json.dumps({'name': 'INTERNAL_SERVICE_ERROR'}), 'application/json')
+            return False
+        return True
+
+    def do_GET(self):
+        path = urlparse.urlsplit(self.path).path
+        if not self._simulate():
+            return
+        if path == '/HPPDP/index.php':
+            return self._reply(200, '<html><body>Moneris Hosted Paypage (fake)</body></html>')
+        if path.startswith('/v1/payments/payment/'):
+            payment_id = path.rsplit('/', 1)[1]
+            return self._reply(200, json.dumps({'id': payment_id, 'state': 'approved'}), 'application/json')
+        self._reply(404, 'Not Found')
+
+    def do_POST(self):
+        path = urlparse.urlsplit(self.path).path
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else ''
+        if not self._simulate():
+            return
+        if path == '/HPPDP/index.php':
+            return self._reply(200, '<html><body>Moneris Hosted Paypage (fake)</body></html>')
+        if path == '/HPPDP/verifyTxn.php':
+            params = dict(urlparse.parse_qsl(body))
+            key = params.get('transactionKey', '')
+            try:
+                order_id, amount = parse_transaction_key(key)
+            except (TypeError, ValueError):
+                return self._reply(200, 'response_code = null<br>status = Invalid-Bad_Source<br>amount = null'
+                                        '<br>transactionKey = %s<br>order_id = null' % key)
+            return self._reply(200, '<br>'.join([
+                'response_code = 027',
+                'status = Valid-Approved',
+                'amount = %s' % amount,
+                'transactionKey = %s' % key,
+                'order_id = %s' % order_id,
+            ]))
+        if path == '/v1/oauth2/token':
+            return self._reply(200, json.dumps({
+                'access_token': 'fake-%s' % random.getrandbits(64),
+                'token_type': 'Bearer',
+                'expires_in': 3600,
+            }), 'application/json')
+        if path == '/v1/payments/payment':
+            return self._reply(201, json.dumps({
+                'id': 'PAY-%s' % random.getrandbits(48),
+                'state': 'approved',
+            }), 'application/json')
+        if path == '/v1/vault/credit-card':
+            card = json.loads(body or '{}')
+            return self._reply(201, json.dumps({
+                'id': 'CARD-%s' % random.getrandbits(48),
+                'state': 'ok',
+                'number': 'x' * 12 + card.get('number', '')[-4:],
+                'type': card.get('type'),
+            }), 'application/json')
+        self._reply(404, 'Not Found')
+
+
+class FakeMonerisServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, jitter=0.0, error_rate=0.0, verbose=False):
+        HTTPServer.__init__(self, address, FakeMonerisHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=50, help='base latency in milliseconds')
+    parser.add_argument('--jitter', type=float, default=20, help='random extra latency in milliseconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with a 503')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+    server = FakeMonerisServer((args.host, args.port), latency=args.latency / 1000.0,
+                               jitter=args.jitter / 1000.0, error_rate=args.error_rate, verbose=args.verbose)
+    print('Fake Moneris listening on http://%s:%s' % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print('%s requests served, %s errors' % (server.requests, server.errors))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+""" Load generator for the Moneris callback routes.
+
+Creates draft Moneris transactions through XML-RPC, then posts the matching
+IPN and/or DPN notifications to a running server with a number of
+concurrent clients, and reports throughput and latency percentiles. The
+acquirer must be in the ``test`` environment and the server configured with
+``moneris_test_server`` pointing to ``fake_moneris.py``.
+
+With ``--dsn`` and the pg_stat_statements extension installed, the number
+of SQL statements executed per callback is reported as well. With
+``--max-p99`` the script exits with an error when the p99 latency exceeds
+the given number of milliseconds, so it can gate a CI job.
+"""
+
+import argparse
+import httplib
+import random
+import sys
+import threading
+import time
+import urllib
+import urlparse
+import xmlrpclib
+
+from fake_moneris import make_transaction_key
+from stats import format_summary, summarize
+
+
+def create_transactions(args):
+    common = xmlrpclib.ServerProxy('%s/xmlrpc/2/common' % args.url)
+    uid = common.authenticate(args.database, args.login, args.password, {})
+    models = xmlrpclib.ServerProxy('%s/xmlrpc/2/object' % args.url, allow_none=True)
+
+    def call(model, method, *params):
+        return models.execute_kw(args.database, uid, args.password, model, method, list(params))
+
+    acquirer_ids = call('payment.acquirer', 'search', [('provider', '=', 'moneris')])
+    assert acquirer_ids, 'no Moneris acquirer found'
+    acquirer_id = acquirer_ids[0]
+    call('payment.acquirer', 'write', [acquirer_id], {'environment': 'test'})
+    currency_id = call('res.currency', 'search', [('name', '=', 'CAD')])[0]
+    country_id = call('res.country', 'search', [('code', '=', 'CA')])[0]
+
+    run = '%x' % random.getrandbits(32)
+    transactions = []
+    for i in range(args.transactions):
+        reference = 'BENCH-%s-%06d' % (run, i)
+        amount = round(random.uniform(1, 500), 2)
+        call('payment.transaction', 'create', {
+            'reference': reference,
+            'acquirer_id': acquirer_id,
+            'amount': amount,
+            'currency_id': currency_id,
+            'partner_country_id': country_id,
+        })
+        transactions.append((reference, amount))
+    return transactions
+
+
+def callback_data(reference, amount, index):
+    order_id = 'mhp%s' % reference
+    return {
+        'rvaroid': reference,
+        'response_order_id': order_id,
+        'transactionKey': make_transaction_key(order_id, amount),
+        'response_code': '027',
+        'result': '1',
+        'charge_total': '%.2f' % amount,
+        'txn_num': '%d-0_10' % (100000 + index),
+        'trans_name': 'purchase',
+        'iso_code': '01',
+        'bank_transaction_id': '%d' % (660000000000 + index),
+        'bank_approval_code': '%06d' % index,
+        'Card': 'V',
+        'f4l4': '4242***4242',
+        'cardholder': 'Bench Mark',
+    }
+
+
+def query_count(dsn, database):
+    """ Total number of statements recorded by pg_stat_statements for the
+    database, or None if it is not available. """
+    if not dsn:
+        return None
+    import psycopg2
+    conn = psycopg2.connect(dsn)
+    try:
+        cr = conn.cursor()
+        cr.execute("""
+            SELECT sum(calls) FROM pg_stat_statements s
+              JOIN pg_database d ON d.oid = s.dbid
+             WHERE d.datname = %s
+        """, (database,))
+        return int(cr.fetchone()[0] or 0)
+    except psycopg2.Error as e:
+        print('pg_stat_statements unavailable: %s' % e)
+        return None
+    finally:
+        conn.close()
+
+
+def run_load(args, jobs):
+    """ Post every (path, data) of ``jobs`` using ``args.concurrency`` clients
+    with keep-alive connections; return the latencies and error count. """
+    parts = urlparse.urlsplit(args.url)
+    lock = threading.Lock()
+    latencies, errors = [], [0]
+    queue = list(reversed(jobs))
+
+    def client():
+        conn = httplib.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+        while True:
+            with lock:
+                if not queue:
+                    break
+                path, data = queue.pop()
+            body = urllib.urlencode(data)
+            start = time.time()
+            try:
+                conn.request('POST', path, body, {'Content-Type': 'application/x-www-form-urlencoded'})
+                response = conn.getresponse()
+                response.read()
+                ok = response.status < 400
+            except Exception:
+                conn.close()
+                conn = httplib.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+                ok = False
+            elapsed = time.time() - start
+            with lock:
+                latencies.append(elapsed)
+                if not ok:
+                    errors[0] += 1
+        conn.close()
+
+    threads = [threading.Thread(target=client) for dummy in range(args.concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0], time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:8069', help='server base URL')
+    parser.add_argument('-d', '--database', required=True)
+    parser.add_argument('--login', default='admin')
+    parser.add_argument('--password', default='admin')
+    parser.add_argument('--transactions', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--mode', choices=['ipn', 'dpn', 'both'], default='both',
+                        help='callbacks sent per transaction')
+    parser.add_argument('--dsn', help='libpq connection string to read pg_stat_statements')
+    parser.add_argument('--max-p99', type=float, help='fail if the p99 latency exceeds this (ms)')
+    args = parser.parse_args()
+
+    print('Creating %s transactions...' % args.transactions)
+    transactions = create_transactions(args)
+    jobs = []
+    for index, (reference, amount) in enumerate(transactions):
+        data = callback_data(reference, amount, index)
+        if args.mode in ('ipn', 'both'):
+            jobs.append(('/payment/moneris/ipn/', data))
+        if args.mode in ('dpn', 'both'):
+            jobs.append(('/payment/moneris/dpn', data))
+
+    queries_before = query_count(args.dsn, args.database)
+    latencies, errors, duration = run_load(args, jobs)
+    queries_after = query_count(args.dsn, args.database)
+
+    summary = summarize(latencies, duration)
+    print(format_summary(args.mode, summary))
+    print('errors: %s' % errors)
+    if queries_before is not None and queries_after is not None:
+        print('SQL statements per callback: %.1f' % ((queries_after - queries_before) / float(len(jobs) or 1)))
+
+    if errors or (args.max_p99 is not None and summary['p99'] > args.max_p99):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
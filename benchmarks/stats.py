@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+""" Latency statistics for the benchmark scripts. """
+
+import math
+
+
+def percentile(values, pct):
+    """ Nearest-rank percentile of an already sorted list. """
+    if not values:
+        return 0.0
+    rank = max(0, min(len(values) - 1, int(math.ceil(pct / 100.0 * len(values))) - 1))
+    return values[rank]
+
+
+def summarize(latencies, duration):
+    """ Return throughput and p50/p95/p99/max latencies (in milliseconds). """
+    values = sorted(latencies)
+    return {
+        'count': len(values),
+        'throughput': len(values) / duration if duration else 0.0,
+        'p50': percentile(values, 50) * 1000,
+        'p95': percentile(values, 95) * 1000,
+        'p99': percentile(values, 99) * 1000,
+        'max': (values[-1] if values else 0.0) * 1000,
+    }
+
+
+def format_summary(label, summary):
+    return ('%(label)-12s %(count)6d req  %(throughput)8.1f req/s  '
+            'p50 %(p50)7.1fms  p95 %(p95)7.1fms  p99 %(p99)7.1fms  max %(max)7.1fms') % dict(summary, label=label)
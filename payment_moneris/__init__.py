@@ -21,3 +21,4 @@
 
 import models
 import controllers
+import cli
@@ -4,15 +4,17 @@
     'name': 'Moneris Payment Acquirer',
     'category': 'Hidden',
     'summary': 'Payment Acquirer: Moneris Implementation',
-    'version': '1.0',
+    'version': '1.1',
     'description': """Moneris Payment Acquirer""",
     'author': 'xyenDev',
     'depends': ['payment'],
     'data': [
+        'security/ir.model.access.csv',
         'views/moneris.xml',
         'views/payment_acquirer.xml',
         'views/res_config_view.xml',
         'data/moneris.xml',
+        'data/moneris_cron.xml',
         'views/website_template.xml',
     ],
     'installable': True,
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+""" Maintenance commands of the Moneris acquirer, run with the server:
+
+    openerp-server moneris rebuild-settlements -c /etc/openerp-server.conf -d mydb [--from 2026-01-01]
+"""
+
+import argparse
+
+import openerp
+from openerp import api, SUPERUSER_ID
+from openerp.cli import Command
+
+
+class Moneris(Command):
+    """ Moneris maintenance commands """
+
+    def rebuild_settlements(self, registry, cr, args):
+        registry['payment.moneris.settlement'].rebuild(cr, SUPERUSER_ID, date_from=args.date_from)
+
+    def run(self, cmdargs):
+        parser = argparse.ArgumentParser(prog='openerp-server moneris', description=self.__doc__)
+        parser.add_argument('action', choices=['rebuild-settlements'])
+        parser.add_argument('-c', '--config', help='server configuration file')
+        parser.add_argument('-d', '--database', required=True, help='database with payment_moneris installed')
+        parser.add_argument('--from', dest='date_from',
+                            help='first day (YYYY-MM-DD) to rebuild, all days by default')
+        args = parser.parse_args(cmdargs)
+        openerp.tools.config.parse_config(['-c', args.config] if args.config else [])
+
+        registry = openerp.registry(args.database)
+        with api.Environment.manage(), registry.cursor() as cr:
+            getattr(self, args.action.replace('-', '_'))(registry, cr, args)
@@ -4,10 +4,13 @@ try:
     import simplejson as json
 except ImportError:
     import json
+import httplib
 import logging
-import pprint
+import socket
 import urllib2
 import werkzeug
+import werkzeug.exceptions
+import werkzeug.wrappers
 from openerp import SUPERUSER_ID
 
 def unescape(s):
@@ -20,6 +23,9 @@ def unescape(s):
 
 from openerp import http, SUPERUSER_ID
 from openerp.http import request
+from openerp.addons.payment_moneris.lib import callback_log, metrics, ratelimit
+from openerp.addons.payment_moneris.models.moneris_ipn import QUEUED
+from openerp.tools import config
 
 _logger = logging.getLogger(__name__)
 
@@ -41,76 +47,117 @@ class MonerisController(http.Controller):
         return return_url
 
     def moneris_validate_data(self, **post):
-        """ Moneris IPN: three steps validation to ensure data correctness
-
-         - step 1: return an empty HTTP 200 response -> will be done at the end
-           by returning ''
-         - step 2: POST the complete, unaltered message back to Moneris (preceded
-           by cmd=_notify-validate), with same encoding
-         - step 3: moneris send either VERIFIED or INVALID (single word)
-
-        Once data is validated, process it. """
-        res = False
-        cr, uid, context = request.cr, request.uid, request.context
-        reference = post.get('rvaroid')
-        tx = None
-        if reference:
-            tx_ids = request.registry['payment.transaction'].search(cr, uid, [('reference', '=', reference)], context=context)
-            if tx_ids:
-                tx = request.registry['payment.transaction'].browse(cr, uid, tx_ids[0], context=context)
-        if tx:
-            moneris_urls = request.registry['payment.acquirer']._get_moneris_urls(cr, uid, tx and tx.acquirer_id and tx.acquirer_id.environment or 'prod', context=context)
-            validate_url = moneris_urls['moneris_auth_url']
-        else:
-            _logger.warning('Moneris: No order found')
-            return res
-
-        sid = tx.acquirer_id.moneris_email_account
-        key = tx.acquirer_id.moneris_seller_account
-
-        new_post = dict(ps_store_id=sid, hpp_key=key, transactionKey=post.get('transactionKey'))
-        
-        urequest = urllib2.Request(validate_url, werkzeug.url_encode(new_post))
-        uopen = urllib2.urlopen(urequest)
-        resp = uopen.read()
-        _logger.info(resp)
-
-        part = resp.split('<br>')
-        new_response = dict([s.split(' = ') for s in part])
-        _logger.info(new_response)
-
-        success = post.get('response_code')
+        """ Verify the callback data with Moneris and process it, see
+        ``payment.transaction._moneris_verify_data``. On communication errors
+        with Moneris the data is queued to be verified again in the
+        background, and ``QUEUED`` is returned. """
+        cr, context = request.cr, request.context
         try:
-            if (int(success) < 50 and post.get('result') == '1' and 
-                    new_response.get('response_code') is not 'null' and int(new_response.get('response_code')) < 50 and 
-                    new_response.get('status') == 'Valid-Approved' and 
-                    new_response.get('amount') is not 'null' and float(new_response.get('amount')) == float(post.get('charge_total')) and 
-                    new_response.get('transactionKey') == post.get('transactionKey') and 
-                    new_response.get('order_id') == post.get('response_order_id')
-                ):
-                _logger.info('Moneris: validated data')
-                res = request.registry['payment.transaction'].form_feedback(cr, SUPERUSER_ID, post, 'moneris', context=context)
+            return request.registry['payment.transaction']._moneris_verify_data(cr, SUPERUSER_ID, post, context=context)
+        except (urllib2.URLError, httplib.HTTPException, socket.error) as e:
+            _logger.warning('Moneris: unable to verify transaction %s: %s', post.get('rvaroid'), e)
+            # keep the data, it will be verified again in the background
+            request.registry['payment.moneris.ipn'].enqueue(cr, SUPERUSER_ID, post, context=context)
+            return QUEUED
+
+    def _throttle(self, kind, post, verify=True):
+        """ Return the response refusing a callback over the rate limit of
+        its source address (429) or, when it is about to be verified, over the
+        cap of verifications in progress (503); ``queued`` for a callback
+        over the rate limit of its reference; None if it may be processed.
+
+        Refusals are cheap and Moneris sends IPNs again later. Callbacks over
+        the limit of their reference are queued to be verified in the
+        background instead, as references are guessable: a flood about a
+        reference must not make its genuine callbacks get lost. They are
+        queued once per transactionKey and order id, and refused (503) while
+        the queue is full. """
+        Queue = request.registry['payment.moneris.ipn']
+        cr, context = request.cr, request.context
+        reason, retry_after = ratelimit.check(request.httprequest.remote_addr, post.get('rvaroid'))
+        status = 429
+        if reason == 'reference':
+            if Queue.is_full(cr, SUPERUSER_ID, context=context):
+                reason, retry_after, status = 'queue_full', 60, 503
             else:
-                _logger.warning('Moneris: answered INVALID on data verification: ' + new_response.get('status') + '/' + post.get('response_order_id'))
-        except ValueError:
-            _logger.warning('Moneris: answered INVALID on data verification: ' + new_response.get('status') + '/' + post.get('response_order_id'))
-
-
-        return res
+                metrics.registry.inc('moneris_throttled_total', {'route': kind, 'reason': reason})
+                _logger.warning('Moneris: %s for %s throttled (%s), queued', kind, post.get('rvaroid'), reason)
+                Queue.enqueue(cr, SUPERUSER_ID, post, context=context)
+                return 'queued'
+        if not reason and verify and not request.registry['payment.moneris.callback'].take_verification_slot(
+                cr, SUPERUSER_ID, context=context):
+            reason, retry_after, status = 'inflight', 1, 503
+        if not reason:
+            return None
+        metrics.registry.inc('moneris_throttled_total', {'route': kind, 'reason': reason})
+        _logger.warning('Moneris: %s for %s throttled (%s)', kind, post.get('rvaroid'), reason)
+        return werkzeug.wrappers.Response(httplib.responses[status], status=status, headers=[
+            ('Retry-After', str(retry_after)),
+        ])
+
+    def _check_metrics_token(self, **get):
+        """ Whether the request carries the ``moneris_metrics_token`` of the
+        server configuration, as a Bearer token or a ``token`` parameter. """
+        token = config.get('moneris_metrics_token')
+        authorization = request.httprequest.headers.get('Authorization', '')
+        return bool(token) and token in (get.get('token'), authorization.replace('Bearer ', '', 1))
+
+    @http.route('/payment/moneris/metrics', type='http', auth='none', methods=['GET'])
+    def moneris_metrics(self, **get):
+        """ Moneris hot path metrics in the Prometheus text format. Only served
+        when ``moneris_metrics_token`` is set in the server configuration, to
+        clients giving it as a Bearer token or a ``token`` parameter. """
+        if not self._check_metrics_token(**get):
+            return werkzeug.exceptions.NotFound()
+        return request.make_response(metrics.registry.render(), headers=[
+            ('Content-Type', 'text/plain; version=0.0.4'),
+        ])
+
+    @http.route('/payment/moneris/debug/callbacks', type='http', auth='none', methods=['GET'])
+    def moneris_recent_callbacks(self, **get):
+        """ Redacted last callbacks received by this server process, when
+        ``moneris_log_ring_size`` is set. Protected like the metrics route. """
+        if callback_log.ring is None or not self._check_metrics_token(**get):
+            return werkzeug.exceptions.NotFound()
+        return request.make_response(json.dumps(callback_log.ring.items()), headers=[
+            ('Content-Type', 'application/json'),
+        ])
 
     @http.route('/payment/moneris/ipn/', type='http', auth='none', methods=['POST'])
     def moneris_ipn(self, **post):
         """ Moneris IPN. """
-        _logger.info('Beginning Moneris IPN form_feedback with post data %s', pprint.pformat(post))  # debug
+        callback_log.log_callback(_logger, 'ipn', post)
+        Queue = request.registry['payment.moneris.ipn']
+        is_async = Queue.is_async(request.cr, SUPERUSER_ID, context=request.context)
+        throttled = self._throttle('ipn', post, verify=not is_async)
+        if throttled == 'queued':
+            return ''
+        elif throttled:
+            return throttled
+        if is_async:
+            Queue.enqueue(request.cr, SUPERUSER_ID, post, context=request.context)
+            return ''
         self.moneris_validate_data(**post)
         return ''
 
     @http.route('/payment/moneris/dpn', type='http', auth="none", methods=['POST'])
     def moneris_dpn(self, **post):
         """ Moneris DPN """
-        _logger.info('Beginning Moneris DPN form_feedback with post data %s', pprint.pformat(post))  # debug
+        callback_log.log_callback(_logger, 'dpn', post)
         return_url = self._get_return_url(**post)
-        if self.moneris_validate_data(**post):
+        throttled = self._throttle('dpn', post)
+        if throttled == 'queued':
+            # the payment is verified in the background; the return page
+            # shows the transaction as waiting for confirmation until then
+            return werkzeug.utils.redirect(return_url)
+        elif throttled:
+            return throttled
+        result = self.moneris_validate_data(**post)
+        if result == QUEUED:
+            # as for throttled DPNs, the return page shows the transaction as
+            # waiting for confirmation until it is verified in the background
+            return werkzeug.utils.redirect(return_url)
+        elif result:
             return werkzeug.utils.redirect(return_url)
         else:
             return werkzeug.utils.redirect(self._cancel_url)
@@ -119,30 +166,11 @@ class MonerisController(http.Controller):
     def moneris_cancel(self, **post):
         """ When the user cancels its Moneris payment: GET on this route """
         cr, uid, context = request.cr, SUPERUSER_ID, request.context
-        _logger.info('Beginning Moneris cancel with post data %s', pprint.pformat(post))  # debug
+        callback_log.log_callback(_logger, 'cancel', post)
         reference = post.get('rvaroid')
         if reference:
-            sales_order_obj = request.registry['sale.order']
-            so_ids = sales_order_obj.search(cr, uid, [('name', '=', reference)], context=context)
-            if so_ids:
-                '''return_url = '/shop/payment/get_status/' + str(so_ids[0])'''
-                so = sales_order_obj.browse(cr, uid, so_ids[0], context=context)
-                if so:
-                    _logger.info('cancel')
-                    '''
-                    tx.write({'state': 'cancel'})
-                    sale_order_obj.action_cancel(cr, SUPERUSER_ID, [order.id], context=request.context)
-                    '''
-                    '''
-                    tx_ids = request.registry['payment.transaction'].search(cr, uid, [('reference', '=', reference)], context=context)
-                    for tx in tx_ids:
-                        tx = request.registry['payment.transaction'].browse(cr, uid, tx, context=context)
-                        tx.write({'state': 'cancel'})
-                    sales_order_obj.write(cr, SUPERUSER_ID, [so.id], {'payment_acquirer_id': None,}, context=context)
-                    '''
-                    '''
-                    action_cancel(cr, SUPERUSER_ID, so.id, context=request.context)
-                    '''
-                _logger.info('done')
+            # only the visitor who started the checkout may cancel it
+            request.registry['payment.transaction'].moneris_cancel_reference(
+                cr, uid, reference, request.session.get('sale_transaction_id'), context=context)
         return_url = '/shop/cart'
         return werkzeug.utils.redirect(return_url)
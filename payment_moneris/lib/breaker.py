@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+from openerp.tools import config
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker(object):
+    """ Per-process circuit breaker guarding calls to a Moneris environment.
+
+    After ``failure_threshold`` consecutive failures the circuit opens and
+    calls fail fast. Once ``reset_timeout`` seconds have elapsed, a single
+    call is let through as a probe (half-open): its success closes the
+    circuit, its failure opens it for another ``reset_timeout``. While the
+    service stays down, a probe is thus sent every ``reset_timeout`` seconds.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._state = CLOSED
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self._state == OPEN and time.time() - self.opened_at >= self.reset_timeout:
+            return HALF_OPEN
+        return self._state
+
+    def allow(self):
+        """ Whether a call may be attempted now. """
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN and time.time() - self.opened_at < self.reset_timeout:
+                return False
+            if self._probing:
+                return False
+            # send a probe
+            self._state = HALF_OPEN
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._state = CLOSED
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self._state = OPEN
+                self.opened_at = time.time()
+            self._probing = False
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(environment):
+    """ Return the circuit breaker of a Moneris environment (``prod`` or
+    ``test``), configured with ``moneris_breaker_threshold`` and
+    ``moneris_breaker_reset`` from the server configuration. """
+    environment = environment or 'prod'
+    breaker = _breakers.get(environment)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(environment)
+            if breaker is None:
+                breaker = _breakers[environment] = CircuitBreaker(
+                    environment,
+                    failure_threshold=int(config.get('moneris_breaker_threshold') or 5),
+                    reset_timeout=float(config.get('moneris_breaker_reset') or 30))
+    return breaker
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+""" Redacted, lazily formatted logging of Moneris callbacks.
+
+Every callback is logged on one line with its reference, order id and
+result. The full (redacted) payload is only formatted for a sample of the
+callbacks (``moneris_log_sample_rate``, 0 by default) or when debug logging
+is enabled. When ``moneris_log_ring_size`` is set, the last callbacks of
+the process are also kept in memory, and only redacted when read.
+"""
+
+import collections
+import logging
+import random
+import threading
+import time
+
+from openerp.tools import config
+
+SENSITIVE_FIELDS = frozenset([
+    'f4l4', 'cardholder', 'hpp_key', 'rvarkey', 'cvd_response_code', 'avs_response_code',
+    'bank_approval_code', 'email', 'address1', 'bill_address_one', 'ship_address_one',
+    # Rest API requests and answers
+    'number', 'cvv2', 'access_token',
+])
+
+REDACTED = '***'
+
+
+def _redact(value):
+    if isinstance(value, dict):
+        return dict((key, REDACTED if key in SENSITIVE_FIELDS and item else _redact(item))
+                    for key, item in value.items())
+    if isinstance(value, list):
+        return [_redact(item) for item in value]
+    return value
+
+
+def redact(data):
+    """ Copy of ``data`` with the values of the sensitive fields masked, in
+    nested dicts and lists too. """
+    return _redact(data or {})
+
+
+class RedactedPayload(object):
+    """ Log argument formatting its dict only when the record is emitted. """
+    __slots__ = ['data']
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return ' '.join('%s=%r' % item for item in sorted(redact(self.data).items()))
+
+
+class CallbackRing(object):
+    """ Bounded, thread-safe buffer of the last callbacks received. """
+
+    def __init__(self, size):
+        self._items = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def append(self, kind, data):
+        with self._lock:
+            self._items.append((time.time(), kind, dict(data)))
+
+    def items(self):
+        with self._lock:
+            items = list(self._items)
+        return [{'time': t, 'kind': kind, 'data': redact(data)} for t, kind, data in items]
+
+
+_ring_size = int(config.get('moneris_log_ring_size') or 0)
+ring = CallbackRing(_ring_size) if _ring_size else None
+
+
+def log_callback(logger, kind, data):
+    """ Log a callback (``ipn``, ``dpn``, ``cancel``) received from Moneris. """
+    if ring is not None:
+        ring.append(kind, data)
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    extra = {'moneris_callback': kind, 'moneris_reference': data.get('rvaroid')}
+    sample_rate = float(config.get('moneris_log_sample_rate') or 0)
+    if logger.isEnabledFor(logging.DEBUG) or (sample_rate and random.random() < sample_rate):
+        logger.info('Moneris %s: %s', kind, RedactedPayload(data), extra=extra)
+    else:
+        logger.info('Moneris %s: reference=%s order_id=%s result=%s response_code=%s',
+                    kind, data.get('rvaroid'), data.get('response_order_id'),
+                    data.get('result'), data.get('response_code'), extra=extra)
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+""" Running Moneris calls concurrently, with threads or, on evented
+(gevent) servers, greenlets. """
+
+from multiprocessing.pool import ThreadPool
+
+
+def is_evented():
+    """ Whether the server runs with gevent (``openerp-gevent``, longpolling
+    worker), in which case blocking I/O must yield to the event loop. """
+    import openerp
+    return bool(getattr(openerp, 'evented', False))
+
+
+def concurrent_map(func, items, workers):
+    """ Return ``[func(item) for item in items]`` computed with at most
+    ``workers`` concurrent calls. ``func`` must not use a database cursor. """
+    items = list(items)
+    if not items:
+        return []
+    workers = max(1, min(workers, len(items)))
+    if is_evented():
+        import gevent.pool
+        return gevent.pool.Pool(workers).map(func, items)
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
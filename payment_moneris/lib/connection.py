@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import httplib
+import logging
+import socket
+import threading
+import urllib2
+import urlparse
+from Queue import LifoQueue, Empty, Full
+from StringIO import StringIO
+
+from openerp.tools import config
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_READ_TIMEOUT = 20.0
+DEFAULT_POOL_SIZE = 4
+
+# errors raised when writing to a keep-alive connection the server already closed
+_STALE_ERRNOS = (errno.EPIPE, errno.ECONNRESET, errno.ECONNABORTED)
+
+
+def _get_timeouts():
+    """ Timeouts and pool size, from the server configuration file:
+
+        moneris_connect_timeout = 5
+        moneris_read_timeout = 20
+        moneris_pool_size = 4
+    """
+    return (
+        float(config.get('moneris_connect_timeout') or DEFAULT_CONNECT_TIMEOUT),
+        float(config.get('moneris_read_timeout') or DEFAULT_READ_TIMEOUT),
+        int(config.get('moneris_pool_size') or DEFAULT_POOL_SIZE),
+    )
+
+
+class ConnectError(socket.error):
+    """ The connection to Moneris could not be established: the request was
+    not sent, so it can safely be sent again. """
+
+
+class SendError(ConnectError):
+    """ The request could not be written whole to the connection: Moneris
+    did not get it, so it can safely be sent again. """
+
+
+class MonerisResponse(object):
+    """ Fully read HTTP response, exposing the same interface as the object
+    returned by urllib2.urlopen. """
+
+    def __init__(self, url, code, msg, headers, body):
+        self.url = url
+        self.code = code
+        self.msg = msg
+        self.headers = headers
+        self.body = body
+
+    def read(self):
+        return self.body
+
+    def getcode(self):
+        return self.code
+
+    def geturl(self):
+        return self.url
+
+    def info(self):
+        return self.headers
+
+    def close(self):
+        pass
+
+
+class CooperativeHTTPConnection(httplib.HTTPConnection):
+    """ HTTP connection on a gevent socket: waiting on I/O yields to the
+    event loop, even when the socket module is not monkey-patched. """
+
+    def connect(self):
+        from gevent import socket as gsocket
+        self.sock = gsocket.create_connection((self.host, self.port), self.timeout, self.source_address)
+
+
+class CooperativeHTTPSConnection(httplib.HTTPSConnection):
+    """ HTTPS counterpart of ``CooperativeHTTPConnection``, verifying the
+    server certificate like the default HTTPS context does. """
+
+    def connect(self):
+        from gevent import socket as gsocket, ssl as gssl
+        sock = gsocket.create_connection((self.host, self.port), self.timeout, self.source_address)
+        self.sock = gssl.create_default_context().wrap_socket(sock, server_hostname=self.host)
+
+
+class MonerisConnectionPool(object):
+    """ Bounded pool of keep-alive connections to a single Moneris host.
+
+    Connections are reused LIFO so that the most recently used (and thus
+    most likely still open) connection is picked first. At most ``maxsize``
+    idle connections are kept; extra connections opened under load are
+    closed once their response is read.
+    """
+
+    def __init__(self, scheme, host, port=None, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT, maxsize=DEFAULT_POOL_SIZE, cooperative=False):
+        self.scheme = scheme
+        self.cooperative = cooperative
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.maxsize = maxsize
+        self._queue = LifoQueue(maxsize)
+
+    def _new_conn(self):
+        if self.scheme == 'https':
+            cls = CooperativeHTTPSConnection if self.cooperative else httplib.HTTPSConnection
+        else:
+            cls = CooperativeHTTPConnection if self.cooperative else httplib.HTTPConnection
+        return cls(self.host, self.port, timeout=self.connect_timeout)
+
+    def _get_conn(self):
+        try:
+            return self._queue.get_nowait(), True
+        except Empty:
+            return self._new_conn(), False
+
+    def _put_conn(self, conn):
+        try:
+            self._queue.put_nowait(conn)
+        except Full:
+            conn.close()
+
+    def _send(self, conn, method, url, path, body, headers, timeout=None):
+        connect_timeout, read_timeout = self.connect_timeout, self.read_timeout
+        if timeout is not None:
+            connect_timeout, read_timeout = min(connect_timeout, timeout), min(read_timeout, timeout)
+        if conn.sock is None:
+            conn.timeout = connect_timeout
+            try:
+                conn.connect()
+            except socket.error as e:
+                raise ConnectError(*e.args)
+        try:
+            conn.request(method, path, body, headers)
+        except socket.error as e:
+            raise SendError(*e.args)
+        # the connect timeout applied so far, switch to the read timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(read_timeout)
+        response = conn.getresponse()
+        data = response.read()
+        if response.will_close:
+            conn.close()
+        else:
+            self._put_conn(conn)
+        return MonerisResponse(url, response.status, response.reason, response.msg, data)
+
+    def urlopen(self, method, url, body=None, headers=None, timeout=None):
+        """ Send a request and read its response. ``timeout`` caps the
+        connect and read timeouts of the pool, e.g. to the time left to the
+        caller.
+
+        A request failing on an idle keep-alive connection the server closed
+        is sent again once on a new connection, unless it is a POST that was
+        sent whole: the server may have processed it before dropping the
+        connection. """
+        parts = urlparse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path = '%s?%s' % (path, parts.query)
+        headers = dict(headers or {})
+
+        conn, reused = self._get_conn()
+        try:
+            return self._send(conn, method, url, path, body, headers, timeout=timeout)
+        except socket.timeout:
+            conn.close()
+            raise
+        except (httplib.BadStatusLine, socket.error) as e:
+            conn.close()
+            stale = reused and (isinstance(e, httplib.BadStatusLine) or getattr(e, 'errno', None) in _STALE_ERRNOS)
+            if not stale or (method == 'POST' and not isinstance(e, SendError)):
+                raise
+            # the server dropped an idle keep-alive connection: retry once on a fresh one
+            _logger.debug('Moneris: stale connection to %s, reconnecting', self.host)
+            conn = self._new_conn()
+            try:
+                return self._send(conn, method, url, path, body, headers, timeout=timeout)
+            except Exception:
+                conn.close()
+                raise
+        except Exception:
+            conn.close()
+            raise
+
+    def clear(self):
+        while True:
+            try:
+                self._queue.get_nowait().close()
+            except Empty:
+                break
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(environment, url, cooperative=False):
+    """ Return the per-process connection pool for ``url`` in the given
+    acquirer environment (``prod`` or ``test``). Cooperative pools use gevent
+    sockets. """
+    parts = urlparse.urlsplit(url)
+    key = (environment, parts.scheme, parts.netloc, cooperative)
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                connect_timeout, read_timeout, maxsize = _get_timeouts()
+                pool = _pools[key] = MonerisConnectionPool(
+                    parts.scheme, parts.hostname, parts.port,
+                    connect_timeout=connect_timeout, read_timeout=read_timeout, maxsize=maxsize,
+                    cooperative=cooperative)
+    return pool
+
+
+def clear_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.clear()
+        _pools.clear()
+
+
+def urlopen(environment, request, cooperative=False, timeout=None):
+    """ Drop-in replacement for ``urllib2.urlopen(request)`` going through the
+    connection pool of ``environment``. The response body is read eagerly;
+    HTTP errors are raised as ``urllib2.HTTPError`` like urllib2 does.
+    ``timeout`` caps the socket timeouts of the pool. """
+    url = request.get_full_url()
+    data = request.get_data()
+    headers = dict(request.header_items())
+    if data is not None and not any(h.lower() == 'content-type' for h in headers):
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    response = get_pool(environment, url, cooperative=cooperative).urlopen(
+        request.get_method(), url, data, headers, timeout=timeout)
+    if response.code >= 400:
+        raise urllib2.HTTPError(url, response.code, response.msg, response.headers, StringIO(response.body))
+    return response
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+""" Moneris Hosted Paypage (HPP) transaction verification.
+
+These helpers do not touch the database, so they can be called from worker
+threads that have no cursor.
+"""
+
+import urllib2
+
+import werkzeug.urls
+
+from openerp.addons.payment_moneris.lib import metrics, transport
+
+
+def parse_verification(resp):
+    """ Parse the ``key = value<br>key = value`` body returned by verifyTxn.php. """
+    part = resp.split('<br>')
+    return dict([s.split(' = ') for s in part])
+
+
+def verify_transaction(environment, url, store_id, hpp_key, transaction_key):
+    """ POST the transactionKey back to verifyTxn.php and return the parsed answer. """
+    new_post = dict(ps_store_id=store_id, hpp_key=hpp_key, transactionKey=transaction_key)
+    urequest = urllib2.Request(url, werkzeug.url_encode(new_post))
+    with metrics.registry.timer('moneris_verify_seconds', {'environment': environment}):
+        uopen = transport.urlopen(environment, urequest)
+    return parse_verification(uopen.read())
+
+
+def is_approved(post, response):
+    """ Whether the callback data ``post`` is an approved payment confirmed by
+    the verification ``response``. Raises ValueError on malformed numbers. """
+    return (
+        int(post.get('response_code')) < 50 and post.get('result') == '1' and
+        response.get('response_code') != 'null' and int(response.get('response_code')) < 50 and
+        response.get('status') == 'Valid-Approved' and
+        response.get('amount') != 'null' and float(response.get('amount')) == float(post.get('charge_total')) and
+        response.get('transactionKey') == post.get('transactionKey') and
+        response.get('order_id') == post.get('response_order_id')
+    )
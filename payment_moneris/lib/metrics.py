@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+""" Counters and histograms of the Moneris hot paths, rendered in the
+Prometheus text exposition format.
+
+Each server process records its own metrics in memory. When
+``moneris_metrics_dir`` is set in the server configuration, every process
+also dumps its metrics to ``<dir>/<pid>.json`` (at most every
+``FLUSH_INTERVAL`` seconds), and the metrics route sums the dumps of all
+processes, so that the values are aggregated across workers. The dumps of
+processes that are gone (e.g. recycled workers) are added to
+``<dir>/retired.json``, so that the summed counters never go down.
+"""
+
+import contextlib
+import errno
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+from openerp.tools import config
+
+_logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 5.0
+
+RETIRED = 'retired.json'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# name -> (type, help)
+METRICS = {
+    'moneris_verify_seconds': ('histogram', 'Round-trip time of verifyTxn.php calls.'),
+    'moneris_rest_seconds': ('histogram', 'Round-trip time of Rest API calls.'),
+    'moneris_callback_db_seconds': ('histogram', 'Time spent in the database and ORM per callback, remote verification excluded.'),
+    'moneris_callbacks_total': ('counter', 'Verified callbacks by result.'),
+    'moneris_retries_total': ('counter', 'Rest API calls retried after a failure.'),
+    'moneris_token_fetches_total': ('counter', 'Access tokens requested from Moneris.'),
+    'moneris_throttled_total': ('counter', 'Callbacks refused by the rate limits or the in-flight cap, by route and reason.'),
+}
+
+
+class MetricsRegistry(object):
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._last_flush = 0.0
+
+    def inc(self, name, labels=None, value=1):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        self._maybe_flush()
+
+    def observe(self, name, value, labels=None):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            index = len(self.buckets)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    index = i
+                    break
+            histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+        self._maybe_flush()
+
+    @contextlib.contextmanager
+    def timer(self, name, labels=None):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, labels)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': [[name, list(labels), value] for (name, labels), value in self._counters.items()],
+                'histograms': [[name, list(labels), list(h[0]), h[1], h[2]] for (name, labels), h in self._histograms.items()],
+            }
+
+    def _maybe_flush(self):
+        directory = config.get('moneris_metrics_dir')
+        if not directory:
+            return
+        now = time.time()
+        # a single thread of the process dumps the metrics per interval
+        with self._lock:
+            if now - self._last_flush < FLUSH_INTERVAL:
+                return
+            self._last_flush = now
+        path = os.path.join(directory, '%s.json' % os.getpid())
+        try:
+            with open(path + '.tmp', 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError) as e:
+            _logger.warning('Moneris: could not write metrics to %s: %s', path, e)
+
+    def _retire(self, directory, filenames):
+        """ Add the dumps ``filenames`` of dead processes to the retired
+        totals, then remove them. A lock file keeps concurrent collectors from
+        adding a dump twice. """
+        retired = os.path.join(directory, RETIRED)
+        try:
+            with open(os.path.join(directory, 'retired.lock'), 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                snapshots, paths = [_load(retired) or {}], []
+                for filename in filenames:
+                    path = os.path.join(directory, filename)
+                    snapshot = _load(path)
+                    if snapshot is not None:
+                        snapshots.append(snapshot)
+                        paths.append(path)
+                if not paths:
+                    return
+                with open(retired + '.tmp', 'w') as f:
+                    json.dump(_to_snapshot(*_aggregate(snapshots)), f)
+                os.rename(retired + '.tmp', retired)
+                for path in paths:
+                    os.remove(path)
+        except (IOError, OSError) as e:
+            _logger.warning('Moneris: could not retire metrics dumps to %s: %s', retired, e)
+
+    def collect(self):
+        """ Snapshots of this process, of the other processes that dumped
+        theirs in ``moneris_metrics_dir`` and of the processes that are gone
+        (see ``_retire``). """
+        snapshots = [self.snapshot()]
+        directory = config.get('moneris_metrics_dir')
+        if directory and os.path.isdir(directory):
+            own = '%s.json' % os.getpid()
+            dead = [filename for filename in os.listdir(directory)
+                    if filename.endswith('.json') and filename not in (own, RETIRED)
+                    and not _alive(filename[:-len('.json')])]
+            if dead:
+                self._retire(directory, dead)
+            for filename in os.listdir(directory):
+                if not filename.endswith('.json') or filename == own:
+                    continue
+                try:
+                    with open(os.path.join(directory, filename)) as f:
+                        snapshots.append(json.load(f))
+                except (IOError, OSError, ValueError):
+                    continue
+        return snapshots
+
+    def render(self):
+        """ Aggregate the collected snapshots in the Prometheus text format. """
+        counters, histograms = _aggregate(self.collect())
+
+        lines = []
+        for name in sorted(METRICS):
+            kind, help = METRICS[name]
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            if kind == 'counter':
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append('%s%s %s' % (name, _labels(labels), value))
+            else:
+                for (metric, labels), (buckets, total, count) in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, value in zip(list(self.buckets) + ['+Inf'], buckets):
+                        cumulative += value
+                        lines.append('%s_bucket%s %s' % (name, _labels(labels + (('le', str(bound)),)), cumulative))
+                    lines.append('%s_sum%s %s' % (name, _labels(labels), repr(total)))
+                    lines.append('%s_count%s %s' % (name, _labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+def _aggregate(snapshots):
+    """ Sum ``snapshots`` into counters and histograms by (name, labels). """
+    counters, histograms = {}, {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot.get('counters', []):
+            key = (name, tuple(tuple(label) for label in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, buckets, total, count in snapshot.get('histograms', []):
+            key = (name, tuple(tuple(label) for label in labels))
+            h = histograms.setdefault(key, [[0] * len(buckets), 0.0, 0])
+            h[0] = [a + b for a, b in zip(h[0], buckets)]
+            h[1] += total
+            h[2] += count
+    return counters, histograms
+
+
+def _to_snapshot(counters, histograms):
+    """ Inverse of ``_aggregate``, in the format of ``MetricsRegistry.snapshot``. """
+    return {
+        'counters': [[name, [list(label) for label in labels], value] for (name, labels), value in counters.items()],
+        'histograms': [[name, [list(label) for label in labels], h[0], h[1], h[2]]
+                       for (name, labels), h in histograms.items()],
+    }
+
+
+def _load(path):
+    """ The snapshot dumped to ``path``, or None if there is none. """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _alive(pid):
+    """ Whether the process ``pid`` (a string) still exists; files not
+    named after a pid are left alone. """
+    try:
+        os.kill(int(pid), 0)
+    except ValueError:
+        return True
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+
+
+registry = MetricsRegistry()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+""" Per-process token buckets limiting the rate of the Moneris callbacks.
+
+Each source address may send ``moneris_source_burst`` callbacks at once,
+then ``moneris_source_rate`` per second; likewise each payment reference with
+``moneris_reference_burst`` and ``moneris_reference_rate``. A rate of 0
+disables the corresponding limit. As the buckets live in memory, the limits
+apply to each server process.
+"""
+
+import collections
+import threading
+import time
+
+from openerp.tools import config
+
+MAX_KEYS = 10000
+
+
+class TokenBucketLimiter(object):
+    """ One token bucket of ``burst`` tokens, refilled at ``rate`` tokens per
+    second, per key. Only the ``max_keys`` most recently used keys are
+    tracked. """
+
+    def __init__(self, rate, burst, max_keys=MAX_KEYS):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        """ Take a token from the bucket of ``key``, if there is one left. """
+        now = time.time()
+        with self._lock:
+            tokens, stamp = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - stamp) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return allowed
+
+    def retry_after(self):
+        """ Seconds until an exhausted bucket has a token again. """
+        return max(1, int(round(1.0 / self.rate)))
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(name, default_rate, default_burst):
+    """ Return the limiter configured by ``moneris_<name>_rate`` and
+    ``moneris_<name>_burst``, or None if it is disabled. """
+    with _limiters_lock:
+        if name not in _limiters:
+            rate = float(config.get('moneris_%s_rate' % name, default_rate) or 0)
+            burst = float(config.get('moneris_%s_burst' % name, default_burst) or 1)
+            _limiters[name] = TokenBucketLimiter(rate, burst) if rate > 0 else None
+        return _limiters[name]
+
+
+def check(source, reference):
+    """ Return ``(reason, retry_after)`` if a callback from ``source`` about
+    ``reference`` exceeds a limit (``source`` or ``reference``), ``(None, 0)``
+    otherwise. """
+    for reason, key, limiter in (
+            ('source', source, get_limiter('source', 0, 20)),
+            ('reference', reference, get_limiter('reference', 0.1, 5))):
+        if limiter is not None and key and not limiter.allow(key):
+            return reason, limiter.retry_after()
+    return None, 0
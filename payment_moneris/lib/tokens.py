@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+import threading
+from datetime import datetime, timedelta
+
+
+class AccessTokenCache(object):
+    """ Process-wide cache of OAuth access tokens.
+
+    Tokens are considered stale ``margin`` seconds before their actual expiry
+    so that they are refreshed before Moneris starts rejecting them. Callers
+    refreshing the same key serialize on a per-key lock: the first one
+    fetches, the others wait and pick up its result (single-flight).
+    """
+
+    def __init__(self):
+        self._tokens = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, margin=0):
+        entry = self._tokens.get(key)
+        if entry and entry[1] - timedelta(seconds=margin) > datetime.utcnow():
+            return entry[0]
+        return None
+
+    def set(self, key, token, expiry):
+        self._tokens[key] = (token, expiry)
+
+    def invalidate(self, key):
+        self._tokens.pop(key, None)
+
+    def lock(self, key):
+        lock = self._locks.get(key)
+        if lock is None:
+            with self._lock:
+                lock = self._locks.setdefault(key, threading.Lock())
+        return lock
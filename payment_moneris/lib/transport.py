@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+""" Transports carrying the outbound HTTP calls to Moneris.
+
+All calls go through ``urlopen(environment, request, timeout=None)``, which
+behaves like ``urllib2.urlopen(request)``: it returns a response with
+``read()`` and raises ``urllib2.HTTPError`` on HTTP errors. ``timeout`` caps
+the socket timeouts of the call. The backend is selected with
+``moneris_transport`` in the server configuration:
+
+ - ``pool`` (default): real calls through the keep-alive connection pool;
+   on evented (gevent) servers, the pool uses cooperative sockets
+ - ``mock``: answers in-process, without any network access
+ - ``record``: real calls, each exchange is also stored in ``moneris_transport_dir``
+ - ``replay``: answers with the exchanges stored in ``moneris_transport_dir``
+"""
+
+import binascii
+import hashlib
+import json
+import os
+import random
+import threading
+import urllib
+import urllib2
+import urlparse
+from StringIO import StringIO
+
+from openerp.tools import config
+
+from openerp.addons.payment_moneris.lib import callback_log, connection
+from openerp.addons.payment_moneris.lib.concurrency import is_evented
+
+
+class Transport(object):
+    """ Interface of the transports. """
+
+    def urlopen(self, environment, request, timeout=None):
+        raise NotImplementedError()
+
+
+class PoolTransport(Transport):
+    """ Production transport, see ``connection.urlopen``. """
+
+    def __init__(self, cooperative=False):
+        self.cooperative = cooperative
+
+    def urlopen(self, environment, request, timeout=None):
+        return connection.urlopen(environment, request, cooperative=self.cooperative, timeout=timeout)
+
+
+def _response(request, code, body, msg='OK', headers=None):
+    url = request.get_full_url()
+    if code >= 400:
+        raise urllib2.HTTPError(url, code, msg, headers or {}, StringIO(body))
+    return connection.MonerisResponse(url, code, msg, headers or {}, body)
+
+
+class MockTransport(Transport):
+    """ In-process stand-in for Moneris.
+
+    Handlers are looked up by URL path and called with the request; they
+    return a ``(code, body)`` tuple. The default verifyTxn.php handler
+    approves transaction keys built with ``make_transaction_key``, the same
+    convention as ``benchmarks/fake_moneris.py``.
+    """
+
+    def __init__(self, handlers=None):
+        self.handlers = {
+            '/HPPDP/verifyTxn.php': self._verify_txn,
+            '/v1/oauth2/token': self._token,
+            '/v1/payments/payment': self._payment,
+            '/v1/vault/credit-card': self._vault,
+        }
+        self.handlers.update(handlers or {})
+
+    @staticmethod
+    def make_transaction_key(order_id, amount):
+        return binascii.hexlify('%s:%.2f' % (order_id, amount))
+
+    def _verify_txn(self, request):
+        key = dict(urlparse.parse_qsl(request.get_data() or '')).get('transactionKey', '')
+        try:
+            order_id, amount = binascii.unhexlify(key).rsplit(':', 1)
+        except (TypeError, ValueError):
+            return 200, 'response_code = null<br>status = Invalid-Bad_Source<br>amount = null' \
+                        '<br>transactionKey = %s<br>order_id = null' % key
+        return 200, '<br>'.join([
+            'response_code = 027',
+            'status = Valid-Approved',
+            'amount = %s' % amount,
+            'transactionKey = %s' % key,
+            'order_id = %s' % order_id,
+        ])
+
+    def _token(self, request):
+        return 200, json.dumps({'access_token': 'mock-%s' % random.getrandbits(64), 'expires_in': 3600})
+
+    def _payment(self, request):
+        path = urlparse.urlsplit(request.get_full_url()).path
+        payment_id = path.rsplit('/', 1)[1] if path.count('/') > 3 else 'PAY-%s' % random.getrandbits(48)
+        return 200, json.dumps({'id': payment_id, 'state': 'approved'})
+
+    def _vault(self, request):
+        card = json.loads(request.get_data() or '{}')
+        return 200, json.dumps({
+            'id': 'CARD-%s' % random.getrandbits(48),
+            'state': 'ok',
+            'number': 'x' * 12 + card.get('number', '')[-4:],
+            'type': card.get('type'),
+        })
+
+    def urlopen(self, environment, request, timeout=None):
+        path = urlparse.urlsplit(request.get_full_url()).path
+        handler = self.handlers.get(path)
+        if handler is None and path.startswith('/v1/payments/payment/'):
+            handler = self.handlers['/v1/payments/payment']
+        if handler is None:
+            return _response(request, 404, 'Not Found', 'Not Found')
+        code, body = handler(request)
+        return _response(request, code, body)
+
+
+class RecordReplayTransport(Transport):
+    """ Stores exchanges on disk (``record``) and answers with them (``replay``).
+
+    An exchange is identified by the environment, method, URL and redacted
+    body of the request; headers (e.g. access tokens) are ignored, so a
+    replay is deterministic whatever the credentials. Card numbers, CVVs,
+    keys and tokens are redacted from the stored bodies (see
+    ``callback_log.SENSITIVE_FIELDS``) and never reach the disk.
+    """
+
+    def __init__(self, directory, mode, transport=None):
+        assert mode in ('record', 'replay')
+        self.directory = directory
+        self.mode = mode
+        self.transport = transport or PoolTransport(cooperative=is_evented())
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _redact_body(body, form=False):
+        """ Redact a JSON body, or a form-encoded one if ``form`` is set; other
+        bodies are returned as is. """
+        if not body:
+            return body or ''
+        try:
+            data = json.loads(body)
+        except ValueError:
+            pass
+        else:
+            redacted = callback_log.redact(data)
+            return body if redacted == data else json.dumps(redacted, sort_keys=True)
+        if form:
+            params = urlparse.parse_qsl(body, keep_blank_values=True)
+            if any(key in callback_log.SENSITIVE_FIELDS for key, value in params):
+                return urllib.urlencode([
+                    (key, callback_log.REDACTED if key in callback_log.SENSITIVE_FIELDS and value else value)
+                    for key, value in params])
+        return body
+
+    def _path(self, environment, request):
+        key = hashlib.sha1('\0'.join([
+            environment or '', request.get_method(), request.get_full_url(), self._redact_body(request.get_data(), form=True),
+        ])).hexdigest()
+        return os.path.join(self.directory, '%s.json' % key)
+
+    def urlopen(self, environment, request, timeout=None):
+        path = self._path(environment, request)
+        if self.mode == 'replay':
+            try:
+                with open(path) as f:
+                    exchange = json.load(f)
+            except IOError:
+                raise urllib2.URLError('no recorded exchange for %s %s' % (request.get_method(), request.get_full_url()))
+            response = exchange['response']
+            return _response(request, response['code'], response['body'].encode('utf-8'), response['msg'])
+
+        try:
+            response = self.transport.urlopen(environment, request, timeout=timeout)
+            code, msg, body = response.code, response.msg, response.read()
+        except urllib2.HTTPError as e:
+            code, msg, body = e.code, e.msg, e.read()
+        exchange = {
+            'request': {'method': request.get_method(), 'url': request.get_full_url(),
+                        'body': self._redact_body(request.get_data(), form=True)},
+            'response': {'code': code, 'msg': msg, 'body': self._redact_body(body).decode('utf-8')},
+        }
+        with self._lock:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(path, 'w') as f:
+                json.dump(exchange, f, indent=1, sort_keys=True)
+        return _response(request, code, body, msg)
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport():
+    """ Return the transport selected by ``moneris_transport``. """
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                mode = config.get('moneris_transport') or 'pool'
+                if mode == 'mock':
+                    _transport = MockTransport()
+                elif mode in ('record', 'replay'):
+                    _transport = RecordReplayTransport(config.get('moneris_transport_dir') or 'moneris_exchanges', mode)
+                else:
+                    _transport = PoolTransport(cooperative=is_evented())
+    return _transport
+
+
+def set_transport(transport):
+    """ Replace the transport of the process, e.g. to install a mock with
+    custom handlers. Pass None to go back to the configured one. """
+    global _transport
+    _transport = transport
+
+
+def urlopen(environment, request, timeout=None):
+    return get_transport().urlopen(environment, request, timeout=timeout)
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+""" Move the raw Moneris response columns of payment_transaction into the
+payment.moneris.txn.data partitions, then drop them, and compute the
+settlement summary of the existing transactions. """
+
+import logging
+from datetime import datetime
+
+from openerp import SUPERUSER_ID
+from openerp.modules.registry import RegistryManager
+from openerp.tools import DEFAULT_SERVER_DATETIME_FORMAT
+
+_logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 10000
+
+
+def migrate(cr, version):
+    if not version:
+        return
+    registry = RegistryManager.get(cr.dbname)
+    move_txn_data(cr, registry)
+    registry['payment.moneris.settlement'].rebuild(cr, SUPERUSER_ID)
+
+
+def move_txn_data(cr, registry):
+    Tx = registry['payment.transaction']
+    TxData = registry['payment.moneris.txn.data']
+    keys = Tx._moneris_txn_data_keys
+    cr.execute("""
+        SELECT column_name FROM information_schema.columns
+         WHERE table_name = 'payment_transaction' AND column_name IN %s
+    """, (tuple(keys),))
+    existing = set(row[0] for row in cr.fetchall())
+    columns = [name for name in keys if name in existing]
+    if not columns:
+        return
+    last_id, moved = 0, 0
+    while True:
+        cr.execute("""
+            SELECT id, create_date, %s FROM payment_transaction
+             WHERE id > %%s AND (%s)
+             ORDER BY id LIMIT %%s
+        """ % (', '.join('"%s"' % name for name in columns),
+               ' OR '.join('"%s" IS NOT NULL' % name for name in columns)),
+            (last_id, BATCH_SIZE))
+        rows = cr.fetchall()
+        if not rows:
+            break
+        for row in rows:
+            payload = dict((keys[name], value) for name, value in zip(columns, row[2:]) if value)
+            day = datetime.strptime(row[1][:19], DEFAULT_SERVER_DATETIME_FORMAT).date()
+            TxData.store(cr, SUPERUSER_ID, row[0], payload, day=day)
+        last_id = rows[-1][0]
+        moved += len(rows)
+    _logger.info('Moneris: moved the response data of %s transactions', moved)
+    for name in columns:
+        cr.execute('ALTER TABLE payment_transaction DROP COLUMN "%s"' % name)
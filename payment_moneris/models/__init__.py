@@ -1,4 +1,9 @@
 # -*- coding: utf-8 -*-
 
 import moneris
+import moneris_callback
+import moneris_ipn
+import moneris_settlement
+import moneris_token
+import moneris_txn_data
 import res_company
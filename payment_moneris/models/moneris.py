@@ -1,22 +1,49 @@
 # -*- coding: utf-'8' "-*-"
 
 import base64
+import httplib
 try:
     import simplejson as json
 except ImportError:
     import json
 import logging
+import psycopg2
+import random
+import socket
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+from functools import partial
 import urlparse
 import werkzeug.urls
 import urllib2
 
 from openerp.addons.payment.models.payment_acquirer import ValidationError
 from openerp.addons.payment_moneris.controllers.main import MonerisController
+from openerp.addons.payment_moneris.lib import callback_log, connection, hpp, metrics, transport
+from openerp.addons.payment_moneris.lib.breaker import get_breaker
+from openerp.addons.payment_moneris.lib.concurrency import concurrent_map
+from openerp.addons.payment_moneris.lib.tokens import AccessTokenCache
+from openerp.addons.payment_moneris.models.moneris_ipn import QUEUED
+from openerp.exceptions import Warning
+from openerp import api, SUPERUSER_ID, tools
 from openerp.osv import osv, fields
+from openerp.tools import config, mute_logger, DEFAULT_SERVER_DATETIME_FORMAT
 from openerp.tools.float_utils import float_compare
+from openerp.tools.translate import _
 
 _logger = logging.getLogger(__name__)
 
+# (dbname, acquirer_id) -> access token, shared by all threads of the process
+_access_tokens = AccessTokenCache()
+
+# read-only snapshot of the configuration of an acquirer, see _moneris_get_config
+MonerisConfig = namedtuple('MonerisConfig', [
+    'id', 'environment', 'store_id', 'hpp_key', 'form_url', 'auth_url', 'rest_url', 'api_url',
+    'fees_active', 'fees_dom_fixed', 'fees_dom_var', 'fees_int_fixed', 'fees_int_var',
+    'company_country_id',
+])
+
 
 class AcquirerMoneris(osv.Model):
     _inherit = 'payment.acquirer'
@@ -27,13 +54,65 @@ class AcquirerMoneris(osv.Model):
             return {
                 'moneris_form_url': 'https://www3.moneris.com/HPPDP/index.php',
                 'moneris_auth_url': 'https://www3.moneris.com/HPPDP/verifyTxn.php',
+                'moneris_rest_url': 'https://api.moneris.com/v1/oauth2/token',
+                'moneris_api_url': 'https://api.moneris.com/v1',
+            }
+        elif config.get('moneris_test_server'):
+            # local stand-in server, see benchmarks/fake_moneris.py
+            server = config['moneris_test_server'].rstrip('/')
+            return {
+                'moneris_form_url': '%s/HPPDP/index.php' % server,
+                'moneris_auth_url': '%s/HPPDP/verifyTxn.php' % server,
+                'moneris_rest_url': '%s/v1/oauth2/token' % server,
+                'moneris_api_url': '%s/v1' % server,
             }
         else:
             return {
                 'moneris_form_url': 'https://esqa.moneris.com/HPPDP/index.php',
                 'moneris_auth_url': 'https://esqa.moneris.com/HPPDP/verifyTxn.php',
+                'moneris_rest_url': 'https://api.sandbox.moneris.com/v1/oauth2/token',
+                'moneris_api_url': 'https://api.sandbox.moneris.com/v1',
             }
 
+    def _get_moneris_service_state(self, cr, uid, ids, name, arg, context=None):
+        return dict(
+            (acquirer.id, get_breaker(acquirer.environment).state)
+            for acquirer in self.browse(cr, uid, ids, context=context))
+
+    def moneris_service_available(self, cr, uid, id, context=None):
+        """ Whether the REST API of the acquirer environment is believed to be
+        up; checkout can use it to warn customers without waiting for a
+        timeout. """
+        acquirer = self.browse(cr, uid, id, context=context)
+        return get_breaker(acquirer.environment).state != 'open'
+
+    @tools.ormcache(skiparg=3)
+    def _moneris_get_config(self, cr, uid, id):
+        """ Return the ``MonerisConfig`` snapshot of acquirer ``id``: store id,
+        hpp key, environment URLs and fees settings. It is cached in the
+        registry until an acquirer is created, written or deleted, or the
+        country of a company changes, so the callback and checkout paths do
+        not read the acquirer again. """
+        acquirer = self.browse(cr, SUPERUSER_ID, id)
+        environment = acquirer.environment or 'prod'
+        urls = self._get_moneris_urls(cr, uid, environment)
+        return MonerisConfig(
+            id=acquirer.id,
+            environment=environment,
+            store_id=acquirer.moneris_email_account,
+            hpp_key=acquirer.moneris_seller_account,
+            form_url=urls['moneris_form_url'],
+            auth_url=urls['moneris_auth_url'],
+            rest_url=urls['moneris_rest_url'],
+            api_url=urls['moneris_api_url'],
+            fees_active=acquirer.fees_active,
+            fees_dom_fixed=acquirer.fees_dom_fixed,
+            fees_dom_var=acquirer.fees_dom_var,
+            fees_int_fixed=acquirer.fees_int_fixed,
+            fees_int_var=acquirer.fees_int_var,
+            company_country_id=acquirer.company_id.country_id.id,
+        )
+
     def _get_providers(self, cr, uid, context=None):
         providers = super(AcquirerMoneris, self)._get_providers(cr, uid, context=context)
         providers.append(['moneris', 'Moneris'])
@@ -51,6 +130,10 @@ class AcquirerMoneris(osv.Model):
         'moneris_api_password': fields.char('Rest API Password'),
         'moneris_api_access_token': fields.char('Access Token'),
         'moneris_api_access_token_validity': fields.datetime('Access Token Validity'),
+        'moneris_service_state': fields.function(
+            _get_moneris_service_state, type='selection', string='Rest API Status',
+            selection=[('closed', 'Available'), ('half_open', 'Recovering'), ('open', 'Unavailable')],
+            help='State of the circuit breaker guarding calls to the Moneris Rest API in this server process.'),
     }
 
     _defaults = {
@@ -90,27 +173,53 @@ class AcquirerMoneris(osv.Model):
                                        the acquirer company country.
             :return float fees: computed fees
         """
-        acquirer = self.browse(cr, uid, id, context=context)
+        return self.moneris_compute_fees_batch(cr, uid, id, [amount], currency_id, [country_id], context=context)[0]
+
+    def moneris_compute_fees_batch(self, cr, uid, id, amounts, currency_id, country_ids, context=None):
+        """ Compute moneris fees for many amounts at once. The acquirer fees
+        configuration is read once for the whole batch.
+
+            :param list amounts: the amounts to pay
+            :param country_ids: IDs of res.country (or None), one per amount,
+                                or a single ID used for all amounts
+            :return list fees: computed fees, in the order of ``amounts``
+        """
+        acquirer = self._moneris_get_config(cr, uid, id)
         if not acquirer.fees_active:
-            return 0.0
-        country = self.pool['res.country'].browse(cr, uid, country_id, context=context)
-        if country and acquirer.company_id.country_id.id == country.id:
-            percentage = acquirer.fees_dom_var
-            fixed = acquirer.fees_dom_fixed
-        else:
-            percentage = acquirer.fees_int_var
-            fixed = acquirer.fees_int_fixed
-        fees = (percentage / 100.0 * amount + fixed ) / (1 - percentage / 100.0)
+            return [0.0] * len(amounts)
+        if not isinstance(country_ids, (list, tuple)):
+            country_ids = [country_ids] * len(amounts)
+        company_country_id = acquirer.company_country_id
+        dom_rate, dom_fixed = acquirer.fees_dom_var / 100.0, acquirer.fees_dom_fixed
+        int_rate, int_fixed = acquirer.fees_int_var / 100.0, acquirer.fees_int_fixed
+        dom_div, int_div = 1 - dom_rate, 1 - int_rate
+        fees = []
+        for amount, country_id in zip(amounts, country_ids):
+            if country_id and country_id == company_country_id:
+                fees.append((dom_rate * amount + dom_fixed) / dom_div)
+            else:
+                fees.append((int_rate * amount + int_fixed) / int_div)
         return fees
 
-    def moneris_form_generate_values(self, cr, uid, id, partner_values, tx_values, context=None):
+    @tools.ormcache(skiparg=3)
+    def _moneris_get_callback_urls(self, cr, uid, id):
+        """ Return, for acquirer ``id``, the absolute return, notify and
+        cancel URLs built on ``web.base.url``. Cached until the parameter
+        changes (see ``IrConfigParameter``). """
         base_url = self.pool['ir.config_parameter'].get_param(cr, uid, 'web.base.url')
-        acquirer = self.browse(cr, uid, id, context=context)
+        return {
+            'return': '%s' % urlparse.urljoin(base_url, MonerisController._return_url),
+            'notify_url': '%s' % urlparse.urljoin(base_url, MonerisController._notify_url),
+            'cancel_return': '%s' % urlparse.urljoin(base_url, MonerisController._cancel_url),
+        }
+
+    def moneris_form_generate_values(self, cr, uid, id, partner_values, tx_values, context=None):
+        acquirer = self._moneris_get_config(cr, uid, id)
 
         moneris_tx_values = dict(tx_values)
         moneris_tx_values.update({
             'cmd': '_xclick',
-            'business': acquirer.moneris_email_account,
+            'business': acquirer.store_id,
             'item_name': tx_values['reference'],
             'item_number': tx_values['reference'],
             'amount': tx_values['amount'],
@@ -123,15 +232,18 @@ class AcquirerMoneris(osv.Model):
             'zip': partner_values['zip'],
             'first_name': partner_values['first_name'],
             'last_name': partner_values['last_name'],
-            'return': '%s' % urlparse.urljoin(base_url, MonerisController._return_url),
-            'notify_url': '%s' % urlparse.urljoin(base_url, MonerisController._notify_url),
-            'cancel_return': '%s' % urlparse.urljoin(base_url, MonerisController._cancel_url),
         })
-        tx_ids = self.pool['payment.transaction'].search(cr, uid, [('reference', '=', tx_values['reference'])], context=context)
-        for tx in tx_ids:
-            tx = self.pool['payment.transaction'].browse(cr, uid, tx, context=context)
-            tx.write({'amount': tx_values['amount']})
-                    
+        moneris_tx_values.update(self._moneris_get_callback_urls(cr, uid, id))
+
+        # keep the transaction amount in sync, only touching rows that differ
+        Tx = self.pool['payment.transaction']
+        tx_ids = Tx.search(cr, uid, [
+            ('reference', '=', tx_values['reference']),
+            ('amount', '!=', tx_values['amount']),
+        ], context=context)
+        if tx_ids:
+            Tx.write(cr, uid, tx_ids, {'amount': tx_values['amount']}, context=context)
+
         if acquirer.fees_active:
             moneris_tx_values['handling'] = '%.2f' % moneris_tx_values.pop('fees', 0.0)
         if moneris_tx_values.get('return_url'):
@@ -139,56 +251,306 @@ class AcquirerMoneris(osv.Model):
         return partner_values, moneris_tx_values
 
     def moneris_get_form_action_url(self, cr, uid, id, context=None):
-        acquirer = self.browse(cr, uid, id, context=context)
-        return self._get_moneris_urls(cr, uid, acquirer.environment, context=context)['moneris_form_url']
+        return self._moneris_get_config(cr, uid, id).form_url
+
+    @tools.ormcache(skiparg=3)
+    def _moneris_get_company_acquirer(self, cr, uid, company_id):
+        """ Return ``(acquirer_id, moneris_email_account)`` of the published
+        Moneris acquirer of ``company_id``, or ``(False, False)``. Cached until
+        an acquirer is created, written or deleted. """
+        acquirer_ids = self.search(cr, SUPERUSER_ID, [
+            ('website_published', '=', True),
+            ('name', 'ilike', 'moneris'),
+            ('company_id', '=', company_id),
+        ], limit=1)
+        if not acquirer_ids:
+            return False, False
+        acquirer = self.browse(cr, SUPERUSER_ID, acquirer_ids[0])
+        return acquirer.id, acquirer.moneris_email_account
+
+    def create(self, cr, uid, vals, context=None):
+        res = super(AcquirerMoneris, self).create(cr, uid, vals, context=context)
+        self.clear_caches()
+        return res
+
+    def write(self, cr, uid, ids, vals, context=None):
+        if any(f in vals for f in ('moneris_api_username', 'moneris_api_password', 'environment')):
+            # credentials changed: cached tokens belong to the old ones
+            vals = dict(vals, moneris_api_access_token=False, moneris_api_access_token_validity=False)
+            for acquirer_id in (ids if isinstance(ids, (list, tuple)) else [ids]):
+                _access_tokens.invalidate((cr.dbname, acquirer_id))
+        res = super(AcquirerMoneris, self).write(cr, uid, ids, vals, context=context)
+        self.clear_caches()
+        return res
+
+    def unlink(self, cr, uid, ids, context=None):
+        res = super(AcquirerMoneris, self).unlink(cr, uid, ids, context=context)
+        self.clear_caches()
+        return res
+
+    def _moneris_s2s_fetch_access_token(self, cr, uid, acquirer, context=None):
+        """ Request a new access token from Moneris.
 
-    def _moneris_s2s_get_access_token(self, cr, uid, ids, context=None):
-        """
         Note: see # see http://stackoverflow.com/questions/2407126/python-urllib2-basic-auth-problem
         for explanation why we use Authorization header instead of urllib2
         password manager
+
+        :return: tuple (access_token, expiry as a naive UTC datetime)
         """
-        res = dict.fromkeys(ids, False)
         parameters = werkzeug.url_encode({'grant_type': 'client_credentials'})
+        tx_url = self._get_moneris_urls(cr, uid, acquirer.environment)['moneris_rest_url']
+        request = urllib2.Request(tx_url, parameters)
+
+        # add other headers (https://developer.moneris.com/webapps/developer/docs/integration/direct/make-your-first-call/)
+        request.add_header('Accept', 'application/json')
+        request.add_header('Accept-Language', 'en_US')
+
+        # add authorization header
+        base64string = base64.encodestring('%s:%s' % (
+            acquirer.moneris_api_username,
+            acquirer.moneris_api_password)
+        ).replace('\n', '')
+        request.add_header("Authorization", "Basic %s" % base64string)
+
+        metrics.registry.inc('moneris_token_fetches_total', {'environment': acquirer.environment})
+        with metrics.registry.timer('moneris_rest_seconds', {'environment': acquirer.environment, 'call': 'token'}):
+            response = transport.urlopen(acquirer.environment, request)
+        result = json.loads(response.read())
+        response.close()
+        expiry = datetime.utcnow() + timedelta(seconds=int(result.get('expires_in') or 0))
+        return result.get('access_token'), expiry
+
+    def _moneris_s2s_load_access_token(self, cr, uid, acquirer_id, context=None):
+        """ Read the token persisted by any worker. A separate cursor is used
+        to see tokens committed after the current transaction started. """
+        with self.pool.cursor() as token_cr:
+            token_cr.execute("""
+                SELECT moneris_api_access_token, moneris_api_access_token_validity
+                  FROM payment_acquirer WHERE id = %s
+            """, (acquirer_id,))
+            row = token_cr.fetchone()
+        if not row or not row[0] or not row[1]:
+            return None, None
+        validity = row[1]
+        if not isinstance(validity, datetime):
+            validity = datetime.strptime(validity, DEFAULT_SERVER_DATETIME_FORMAT)
+        return row[0], validity
+
+    def _moneris_s2s_store_access_token(self, cr, uid, acquirer_id, token, expiry, context=None):
+        """ Persist the token in its own committed transaction, so that the
+        acquirer row is not kept locked by the payment being processed. """
+        with self.pool.cursor() as token_cr:
+            token_cr.execute("""
+                UPDATE payment_acquirer
+                   SET moneris_api_access_token = %s, moneris_api_access_token_validity = %s
+                 WHERE id = %s
+            """, (token, expiry.strftime(DEFAULT_SERVER_DATETIME_FORMAT), acquirer_id))
 
+    def _moneris_s2s_get_access_token(self, cr, uid, ids, context=None):
+        """ Return a valid access token per acquirer id.
+
+        Tokens are looked up in the process-wide cache, then in the
+        ``moneris_api_access_token*`` columns, and only fetched from Moneris
+        when both are missing or about to expire (``moneris_token_refresh_margin``
+        seconds before expiry, 300 by default). Concurrent callers wait for a
+        single in-flight fetch.
+        """
+        res = dict.fromkeys(ids, False)
+        margin = int(config.get('moneris_token_refresh_margin') or 300)
         for acquirer in self.browse(cr, uid, ids, context=context):
-            tx_url = self._get_moneris_urls(cr, uid, acquirer.environment)['moneris_rest_url']
-            request = urllib2.Request(tx_url, parameters)
-
-            # add other headers (https://developer.moneris.com/webapps/developer/docs/integration/direct/make-your-first-call/)
-            request.add_header('Accept', 'application/json')
-            request.add_header('Accept-Language', 'en_US')
-
-            # add authorization header
-            base64string = base64.encodestring('%s:%s' % (
-                acquirer.moneris_api_username,
-                acquirer.moneris_api_password)
-            ).replace('\n', '')
-            request.add_header("Authorization", "Basic %s" % base64string)
-
-            request = urllib2.urlopen(request)
-            result = request.read()
-            res[acquirer.id] = json.loads(result).get('access_token')
-            request.close()
+            key = (cr.dbname, acquirer.id)
+            token = _access_tokens.get(key, margin)
+            if not token:
+                with _access_tokens.lock(key):
+                    token = _access_tokens.get(key, margin)
+                    if not token:
+                        token, expiry = self._moneris_s2s_load_access_token(cr, uid, acquirer.id, context=context)
+                        if not token or expiry - timedelta(seconds=margin) <= datetime.utcnow():
+                            token, expiry = self._moneris_s2s_fetch_access_token(cr, uid, acquirer, context=context)
+                            self._moneris_s2s_store_access_token(cr, uid, acquirer.id, token, expiry, context=context)
+                        _access_tokens.set(key, token, expiry)
+            res[acquirer.id] = token
         return res
 
+    def _moneris_s2s_renew_access_token(self, cr, uid, acquirer_id, rejected, context=None):
+        """ Drop the access token ``rejected`` by Moneris (HTTP 401) from the
+        process cache and the ``moneris_api_access_token*`` columns, and return
+        a new one. When another caller renewed it in the meantime, its token is
+        returned. A separate cursor is used, so that the worker threads of
+        batch operations may call it too. """
+        key = (cr.dbname, acquirer_id)
+        with _access_tokens.lock(key):
+            token = _access_tokens.get(key)
+            if token and token != rejected:
+                return token
+            _access_tokens.invalidate(key)
+            with self.pool.cursor() as token_cr:
+                token_cr.execute("""
+                    UPDATE payment_acquirer
+                       SET moneris_api_access_token = NULL, moneris_api_access_token_validity = NULL
+                     WHERE id = %s AND moneris_api_access_token = %s
+                """, (acquirer_id, rejected))
+        _logger.info('Moneris: access token of acquirer %s rejected, renewing it', acquirer_id)
+        # the worker threads have no environments of their own to browse with
+        with api.Environment.manage(), self.pool.cursor() as token_cr:
+            return self._moneris_s2s_get_access_token(token_cr, uid, [acquirer_id], context=context)[acquirer_id]
+
+
+class IrConfigParameter(osv.Model):
+    _inherit = 'ir.config_parameter'
+
+    def _moneris_clear_caches(self, cr, uid, ids=None, vals=None, context=None):
+        """ The Moneris callback URLs are cached on top of web.base.url. """
+        if vals is not None and vals.get('key') == 'web.base.url':
+            self.pool['payment.acquirer'].clear_caches()
+        elif ids and self.search(cr, uid, [('id', 'in', ids), ('key', '=', 'web.base.url')], context=context):
+            self.pool['payment.acquirer'].clear_caches()
+
+    def create(self, cr, uid, vals, context=None):
+        self._moneris_clear_caches(cr, uid, vals=vals, context=context)
+        return super(IrConfigParameter, self).create(cr, uid, vals, context=context)
+
+    def write(self, cr, uid, ids, vals, context=None):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        self._moneris_clear_caches(cr, uid, ids=ids, vals=vals, context=context)
+        return super(IrConfigParameter, self).write(cr, uid, ids, vals, context=context)
+
+    def unlink(self, cr, uid, ids, context=None):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        self._moneris_clear_caches(cr, uid, ids=ids, context=context)
+        return super(IrConfigParameter, self).unlink(cr, uid, ids, context=context)
+
 
 class TxMoneris(osv.Model):
     _inherit = 'payment.transaction'
 
+    # moneris_txn_* field -> key of the verification payload holding its value
+    _moneris_txn_data_keys = {
+        'moneris_txn_type': 'trans_name',
+        'moneris_txn_oid': 'response_order_id',
+        'moneris_txn_response': 'response_code',
+        'moneris_txn_ISO': 'iso_code',
+        'moneris_txn_eci': 'Eci',
+        'moneris_txn_card': 'Card',
+        'moneris_txn_cardf4l4': 'f4l4',
+        'moneris_txn_bankid': 'bank_transaction_id',
+        'moneris_txn_bankapp': 'bank_approval_code',
+    }
+
+    def _get_moneris_txn_data(self, cr, uid, ids, field_names, arg, context=None):
+        payloads = self.pool['payment.moneris.txn.data'].get_payloads(cr, uid, ids, context=context)
+        res = {}
+        for tx_id in ids:
+            payload = payloads.get(tx_id, {})
+            res[tx_id] = dict((name, payload.get(self._moneris_txn_data_keys[name]) or False) for name in field_names)
+        return res
+
+    def _set_moneris_txn_data(self, cr, uid, tx_id, name, value, arg, context=None):
+        TxData = self.pool['payment.moneris.txn.data']
+        payload = TxData.get_payloads(cr, uid, [tx_id], context=context).get(tx_id, {})
+        payload[self._moneris_txn_data_keys[name]] = value or None
+        TxData.store(cr, uid, tx_id, payload, context=context)
+        return True
+
     _columns = {
-        'moneris_txn_id': fields.char('Transaction ID'),
-        'moneris_txn_type': fields.char('Transaction type'),
-        'moneris_txn_oid': fields.char('Order ID'),
-        'moneris_txn_response': fields.char('Response Code'),
-        'moneris_txn_ISO': fields.char('ISO'),
-        'moneris_txn_eci': fields.char('Electronic Commerce Indicator'),
-        'moneris_txn_card': fields.char('Card Type'),
-        'moneris_txn_cardf4l4': fields.char('First 4 Last 4'),
-        'moneris_txn_bankid': fields.char('Bank Transaction ID'),
-        'moneris_txn_bankapp': fields.char('Bank Approval Code'),
+        'moneris_txn_id': fields.char('Transaction ID', select=True),
+        # nodrop: the 1.1 migration moves the values of the former columns, then drops them
+        'moneris_txn_type': fields.function(_get_moneris_txn_data, fnct_inv=_set_moneris_txn_data, nodrop=True, type='char',
+                                            string='Transaction type', multi='moneris_txn_data'),
+        'moneris_txn_oid': fields.function(_get_moneris_txn_data, fnct_inv=_set_moneris_txn_data, nodrop=True, type='char',
+                                           string='Order ID', multi='moneris_txn_data'),
+        'moneris_txn_response': fields.function(_get_moneris_txn_data, fnct_inv=_set_moneris_txn_data, nodrop=True, type='char',
+                                                string='Response Code', multi='moneris_txn_data'),
+        'moneris_txn_ISO': fields.function(_get_moneris_txn_data, fnct_inv=_set_moneris_txn_data, nodrop=True, type='char',
+                                           string='ISO', multi='moneris_txn_data'),
+        'moneris_txn_eci': fields.function(_get_moneris_txn_data, fnct_inv=_set_moneris_txn_data, nodrop=True, type='char',
+                                           string='Electronic Commerce Indicator', multi='moneris_txn_data'),
+        'moneris_txn_card': fields.function(_get_moneris_txn_data, fnct_inv=_set_moneris_txn_data, nodrop=True, type='char',
+                                            string='Card Type', multi='moneris_txn_data'),
+        'moneris_txn_cardf4l4': fields.function(_get_moneris_txn_data, fnct_inv=_set_moneris_txn_data, nodrop=True, type='char',
+                                                string='First 4 Last 4', multi='moneris_txn_data'),
+        'moneris_txn_bankid': fields.function(_get_moneris_txn_data, fnct_inv=_set_moneris_txn_data, nodrop=True, type='char',
+                                              string='Bank Transaction ID', multi='moneris_txn_data'),
+        'moneris_txn_bankapp': fields.function(_get_moneris_txn_data, fnct_inv=_set_moneris_txn_data, nodrop=True, type='char',
+                                               string='Bank Approval Code', multi='moneris_txn_data'),
+        'moneris_capture_id': fields.char('Capture ID', readonly=True,
+                                          help='Moneris id of the capture of an authorized transaction.'),
+        'moneris_data_month': fields.char('Moneris Data Partition', size=6, readonly=True,
+                                          help='Month (YYYYMM) of the partition holding the Moneris response data.'),
+        'moneris_next_poll': fields.datetime('Next Status Poll', readonly=True,
+                                             help='When the status of this pending server-to-server transaction will next be checked.'),
     }
 
+    def _auto_init(self, cr, context=None):
+        res = super(TxMoneris, self)._auto_init(cr, context=context)
+        # callbacks look transactions up by these columns; index them unless
+        # an index (e.g. the unique constraint on reference) already leads with them
+        for column in ('reference', 'acquirer_reference'):
+            cr.execute("""
+                SELECT 1
+                  FROM pg_index i
+                  JOIN pg_class t ON t.oid = i.indrelid
+                  JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = i.indkey[0]
+                 WHERE t.relname = 'payment_transaction' AND a.attname = %s
+            """, (column,))
+            if not cr.fetchone():
+                _logger.info('Creating index on payment_transaction.%s', column)
+                cr.execute('CREATE INDEX payment_transaction_%s_index ON payment_transaction (%s)' % (column, column))
+        return res
+
+    # --------------------------------------------------
+    # STATE MACHINE
+    # --------------------------------------------------
+
+    # allowed state changes of a Moneris transaction; a refund cancels a done one
+    _moneris_transitions = {
+        'draft': ('pending', 'done', 'error', 'cancel'),
+        'pending': ('done', 'error', 'cancel'),
+        'done': ('cancel',),
+        'error': (),
+        'cancel': (),
+    }
+
+    def _moneris_allowed_states(self, cr, uid, tx, context=None):
+        if tx.state == 'cancel' and not tx.date_validate:
+            # an abandoned checkout was cancelled before being paid: the
+            # payment may still go through, e.g. from another browser tab
+            return ('done',)
+        return self._moneris_transitions.get(tx.state, ())
+
+    def _moneris_write_changes(self, cr, uid, tx, values, payload=None, context=None):
+        """ Write on ``tx`` only the ``values`` that differ from its current
+        ones, refusing state changes not allowed by ``_moneris_transitions``
+        (see ``_moneris_allowed_states``).
+        ``date_validate`` and the verification ``payload`` are only written
+        along with a state change.
+
+        :return: False if the state change was refused, True otherwise
+        """
+        state = values.get('state')
+        if state and state != tx.state and state not in self._moneris_allowed_states(cr, uid, tx, context=context):
+            _logger.warning('Moneris: refused to set tx %s from %s to %s', tx.reference, tx.state, state)
+            return False
+        changes = dict(
+            (name, value) for name, value in values.items()
+            if name != 'date_validate' and (tx[name] or False) != (value or False)
+        )
+        if 'state' in changes and values.get('date_validate'):
+            changes['date_validate'] = values['date_validate']
+        if not changes:
+            return True
+        if 'state' in changes:
+            payloads = {tx.id: payload} if payload is not None else None
+            self.pool['payment.moneris.settlement'].record_transitions(
+                cr, uid, [tx], changes['state'], payloads=payloads, context=context)
+            if payload is not None:
+                # the raw response only matters for audits, keep it off the
+                # transaction row; replayed or refused callbacks must not replace it
+                self.pool['payment.moneris.txn.data'].store(cr, uid, tx.id, payload, context=context)
+        return tx.write(changes)
+
     # --------------------------------------------------
     # FORM RELATED METHODS
     # --------------------------------------------------
@@ -200,6 +562,11 @@ class TxMoneris(osv.Model):
             _logger.error(error_msg)
             raise ValidationError(error_msg)
 
+        # transaction already resolved by the caller for this reference
+        tx_id = (context or {}).get('moneris_tx_ids', {}).get(reference)
+        if tx_id:
+            return self.browse(cr, uid, tx_id, context=context)
+
         # find tx -> @TDENOTE use txn_id ?
         tx_ids = self.pool['payment.transaction'].search(cr, uid, [('reference', '=', reference)], context=context)
         if not tx_ids or len(tx_ids) > 1:
@@ -212,6 +579,90 @@ class TxMoneris(osv.Model):
             raise ValidationError(error_msg)
         return self.browse(cr, uid, tx_ids[0], context=context)
 
+    def _moneris_verify_data(self, cr, uid, post, context=None):
+        """ Moneris IPN: three steps validation to ensure data correctness
+
+         - step 1: return an empty HTTP 200 response -> will be done at the end
+           by returning ''
+         - step 2: POST the complete, unaltered message back to Moneris (preceded
+           by cmd=_notify-validate), with same encoding
+         - step 3: moneris send either VERIFIED or INVALID (single word)
+
+        Once data is validated, process it. Callbacks already processed
+        (same transactionKey and response_order_id) get the stored verdict
+        back without being verified again. A callback that waited in vain
+        for a concurrent one of the same reference is queued (see
+        ``payment.moneris.ipn``) and ``QUEUED`` is returned; from the queue
+        itself it fails, to be retried later.
+
+        Communication errors with Moneris are not caught, so that callers can
+        decide whether to give up or retry later. """
+        start = time.time()
+        res = False
+        Callback = self.pool['payment.moneris.callback']
+        transaction_key, order_id = post.get('transactionKey'), post.get('response_order_id')
+        verdict = Callback.get_verdict(cr, uid, transaction_key, order_id, context=context)
+        if verdict is not None:
+            _logger.info('Moneris: callback %s/%s already processed', order_id, transaction_key)
+            return verdict
+
+        reference = post.get('rvaroid')
+        tx = None
+        if reference:
+            tx_ids = self.search(cr, uid, [('reference', '=', reference)], limit=1, context=context)
+            if tx_ids:
+                tx = self.browse(cr, uid, tx_ids[0], context=context)
+        if not tx:
+            _logger.warning('Moneris: No order found')
+            return res
+
+        # the IPN and the DPN of a payment often arrive together: only one of
+        # them verifies it, the other one returns the verdict of the first
+        if not Callback.lock_reference(cr, uid, reference, context=context):
+            _logger.info('Moneris: callback for %s processed concurrently, waiting for its verdict', reference)
+            verdict = Callback.get_committed_verdict(
+                cr, uid, transaction_key, order_id,
+                wait=float(config.get('moneris_callback_lock_wait') or 10), context=context)
+            if verdict is not None:
+                return verdict
+            # the other callback did not finish in time: keep this one's data
+            # to be verified in the background instead of dropping it
+            if (context or {}).get('moneris_ipn_queued'):
+                raise Warning(_('A callback for %s is still being processed.') % reference)
+            _logger.info('Moneris: no verdict for %s in time, queueing the callback', reference)
+            self.pool['payment.moneris.ipn'].enqueue(cr, uid, post, context=context)
+            return QUEUED
+        verdict = Callback.get_committed_verdict(cr, uid, transaction_key, order_id, context=context)
+        if verdict is not None:
+            _logger.info('Moneris: callback %s/%s processed concurrently', order_id, transaction_key)
+            return verdict
+
+        acquirer = self.pool['payment.acquirer']._moneris_get_config(cr, uid, tx.acquirer_id.id)
+        remote_start = time.time()
+        new_response = hpp.verify_transaction(
+            acquirer.environment, acquirer.auth_url, acquirer.store_id, acquirer.hpp_key, post.get('transactionKey'))
+        remote_end = time.time()
+        _logger.debug('Moneris: verification answer for %s: %s', reference, callback_log.RedactedPayload(new_response))
+
+        try:
+            approved = hpp.is_approved(post, new_response)
+        except ValueError:
+            approved = False
+        if approved:
+            metrics.registry.inc('moneris_callbacks_total', {'result': 'approved'})
+            _logger.info('Moneris: validated data')
+            # hand the transaction over to _moneris_form_get_tx_from_data
+            feedback_context = dict(context or {}, moneris_tx_ids={reference: tx.id})
+            res = self.form_feedback(cr, uid, post, 'moneris', context=feedback_context)
+        else:
+            # approved by the callback but not confirmed by Moneris: invalid
+            metrics.registry.inc('moneris_callbacks_total', {'result': 'invalid' if post.get('result') == '1' else 'declined'})
+            _logger.warning('Moneris: answered INVALID on data verification: %s/%s', new_response.get('status'), post.get('response_order_id'))
+
+        res = Callback.record_verdict(cr, uid, transaction_key, order_id, res, tx.id, context=context)
+        metrics.registry.observe('moneris_callback_db_seconds', (remote_start - start) + (time.time() - remote_end))
+        return res
+
     def _moneris_form_get_invalid_parameters(self, cr, uid, tx, data, context=None):
         invalid_parameters = []
         """
@@ -257,66 +708,359 @@ class TxMoneris(osv.Model):
         return invalid_parameters
 
     def _moneris_form_validate(self, cr, uid, tx, data, context=None):
-        status = data.get('result')
+        status, payload = data.get('result'), data
         data = {
             'moneris_txn_id': data.get('txn_num'),
-            'moneris_txn_type': data.get('trans_name'),
-            'moneris_txn_oid': data.get('response_order_id'),
-            'moneris_txn_response': data.get('response_code'),
-            'moneris_txn_ISO': data.get('iso_code'),
-            'moneris_txn_eci': data.get('Eci'),
-            'moneris_txn_card': data.get('Card'),
-            'moneris_txn_cardf4l4': data.get('f4l4'),
-            'moneris_txn_bankid': data.get('bank_transaction_id'),
-            'moneris_txn_bankapp': data.get('bank_approval_code'),
             'partner_reference': data.get('cardholder'),
             'acquirer_reference': data.get('response_order_id')
         }
         if status == '1':
             _logger.info('Validated Moneris payment for tx %s: set as done' % (tx.reference))
             data.update(state='done', date_validate=data.get('date_stamp', fields.datetime.now()))
-            return tx.write(data)
+            return self._moneris_write_changes(cr, uid, tx, data, payload=payload, context=context)
         else:
             error = 'Received unrecognized status for Moneris payment %s: %s, set as error' % (tx.reference, status)
             _logger.info(error)
             data.update(state='error', state_message=error)
-            return tx.write(data)
+            return self._moneris_write_changes(cr, uid, tx, data, payload=payload, context=context)
+
+    # --------------------------------------------------
+    # CANCELLATION
+    # --------------------------------------------------
+
+    def moneris_cancel_reference(self, cr, uid, reference, session_tx_id, context=None):
+        """ Cancel the draft Moneris transaction ``reference``, whose checkout
+        was cancelled on the hosted page. As the cancel route is public, the
+        transaction must be ``session_tx_id``, the one of the visitor's
+        session. Transactions a callback is being processed for are left
+        alone.
+
+        :return: True if the transaction was cancelled
+        """
+        tx_ids = self.search(cr, uid, [('reference', '=', reference)], limit=1, context=context)
+        if not tx_ids or tx_ids[0] != session_tx_id:
+            if tx_ids:
+                _logger.warning('Moneris: refused to cancel tx %s, not the one of the session', reference)
+            return False
+        tx = self.browse(cr, uid, tx_ids[0], context=context)
+        if tx.state != 'draft' or tx.acquirer_id.provider != 'moneris':
+            return False
+        if not self.pool['payment.moneris.callback'].lock_reference(cr, uid, reference, context=context):
+            return False
+        _logger.info('Moneris payment %s cancelled by the customer', reference)
+        return self._moneris_write_changes(cr, uid, tx, {
+            'state': 'cancel',
+            'state_message': _('Cancelled by the customer'),
+        }, context=context)
+
+    def moneris_cancel_stale_drafts(self, cr, uid, age=24, batch_size=500, max_batches=20, context=None):
+        """ Cron entry point: cancel the draft Moneris transactions created
+        more than ``age`` hours ago, ``batch_size`` at a time, each batch in
+        its own short transaction. Rows locked by a callback are skipped, and
+        a run stops after ``max_batches`` batches. """
+        Settlement = self.pool['payment.moneris.settlement']
+        limit = (datetime.utcnow() - timedelta(hours=age)).strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+        cancelled = 0
+        for _batch in range(max_batches):
+            with self.pool.cursor() as batch_cr:
+                batch_cr.execute("""
+                    UPDATE payment_transaction
+                       SET state = 'cancel', state_message = %s,
+                           write_uid = %s, write_date = now() at time zone 'UTC'
+                     WHERE id IN (
+                            SELECT tx.id
+                              FROM payment_transaction tx
+                              JOIN payment_acquirer acquirer ON acquirer.id = tx.acquirer_id
+                             WHERE acquirer.provider = 'moneris'
+                               AND tx.state = 'draft'
+                               AND tx.create_date < %s
+                             ORDER BY tx.id
+                             LIMIT %s
+                               FOR UPDATE OF tx SKIP LOCKED)
+                 RETURNING create_date, acquirer_id, currency_id, amount
+                """, (_('Checkout abandoned'), uid, limit, batch_size))
+                rows = batch_cr.fetchall()
+                deltas = {}
+                for create_date, acquirer_id, currency_id, amount in rows:
+                    delta = deltas.setdefault((create_date[:10], acquirer_id, '', currency_id, 'cancel'), [0, 0.0])
+                    delta[0] += 1
+                    delta[1] += amount
+                Settlement._log_deltas(batch_cr, deltas)
+            cancelled += len(rows)
+            if len(rows) < batch_size:
+                break
+        _logger.info('Moneris: cancelled %s draft transactions older than %s hours', cancelled, age)
+        return True
+
+    # --------------------------------------------------
+    # RECONCILIATION
+    # --------------------------------------------------
+
+    def _moneris_reconcile_batch(self, cr, uid, rows, workers=8, context=None):
+        """ Verify a batch of claimed IPN queue rows concurrently and apply the
+        results.
+
+        The HPP verification needs the transactionKey that Moneris sent with
+        the callback, hence the reconciliation works from the callback data
+        kept in the IPN queue (not yet processed, or dead-lettered). ``rows``
+        are ``(ipn_id, tx_id, post)`` tuples, locked by the caller; only the
+        latest row of each transaction is verified, and its verdict closes
+        the older ones. Transactions whose
+        reference lock is held by a live callback are ``skipped``.
+
+        Remote calls run concurrently (``workers`` threads, or greenlets on an
+        evented server) without using the cursor; results are then applied sequentially through form_feedback
+        (and thus ``_moneris_form_validate``) in the current transaction.
+        """
+        latest, ipn_ids = {}, {}
+        for ipn_id, tx_id, post in rows:
+            ipn_ids.setdefault(tx_id, []).append(ipn_id)
+            if tx_id not in latest or latest[tx_id][0] < ipn_id:
+                latest[tx_id] = (ipn_id, post)
+        stats = dict(processed=len(latest), validated=0, invalid=0, failed=0, skipped=0)
+        Acquirer = self.pool['payment.acquirer']
+        Callback = self.pool['payment.moneris.callback']
+
+        jobs = []
+        for tx in self.browse(cr, uid, sorted(latest), context=context):
+            if not Callback.lock_reference(cr, uid, tx.reference, context=context):
+                # a callback of the transaction is being processed right now
+                stats['skipped'] += 1
+                continue
+            ipn_id, post = latest[tx.id]
+            acquirer = Acquirer._moneris_get_config(cr, uid, tx.acquirer_id.id)
+            jobs.append((tx, ipn_id, post, (
+                acquirer.environment, acquirer.auth_url, acquirer.store_id,
+                acquirer.hpp_key, post.get('transactionKey'))))
+        if not jobs:
+            return stats
+
+        def verify(args):
+            try:
+                return hpp.verify_transaction(*args), None
+            except Exception as e:
+                return None, e
+
+        results = concurrent_map(verify, [job[3] for job in jobs], workers)
+
+        for (tx, ipn_id, post, dummy), (response, error) in zip(jobs, results):
+            if error is not None:
+                stats['failed'] += 1
+                _logger.warning('Moneris reconciliation: could not verify %s: %s', tx.reference, error)
+                continue
+            try:
+                approved = hpp.is_approved(post, response)
+            except ValueError:
+                approved = False
+            try:
+                with cr.savepoint():
+                    res = False
+                    if approved:
+                        feedback_context = dict(context or {}, moneris_tx_ids={tx.reference: tx.id})
+                        res = self.form_feedback(cr, uid, post, 'moneris', context=feedback_context)
+                    res = Callback.record_verdict(
+                        cr, uid, post.get('transactionKey'), post.get('response_order_id'), res, tx.id, context=context)
+                    cr.execute("""
+                        UPDATE payment_moneris_ipn
+                           SET state = 'done', verdict = %s, write_date = now() at time zone 'UTC'
+                         WHERE id IN %s
+                    """, (bool(res), tuple(ipn_ids[tx.id])))
+            except Exception as e:
+                stats['failed'] += 1
+                _logger.warning('Moneris reconciliation: could not apply result for %s: %s', tx.reference, e)
+                continue
+            stats['validated' if res else 'invalid'] += 1
+        return stats
+
+    def moneris_reconcile(self, cr, uid, age=60, batch_size=200, workers=8, context=None):
+        """ Cron entry point: re-verify the Moneris transactions still in draft
+        or pending ``age`` minutes after their creation, for which callback
+        data is left in the IPN queue, committing after each batch.
+
+        Batches are claimed from the queue with ``FOR UPDATE SKIP LOCKED``,
+        like the queue workers do, so that a row is never processed by both.
+        Stale transactions without callback data left in the queue cannot be
+        verified (their callbacks were lost): they are counted as
+        ``unverifiable``.
+        """
+        limit = (datetime.utcnow() - timedelta(minutes=age)).strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+        totals = dict(processed=0, validated=0, invalid=0, failed=0, skipped=0)
+        last_id = 0
+        while True:
+            cr.execute("""
+                SELECT ipn.id, tx.id, ipn.data
+                  FROM payment_moneris_ipn ipn
+                  JOIN payment_transaction tx ON tx.reference = ipn.reference
+                  JOIN payment_acquirer acquirer ON acquirer.id = tx.acquirer_id
+                 WHERE ipn.state != 'done'
+                   AND ipn.id > %s
+                   AND acquirer.provider = 'moneris'
+                   AND tx.state IN ('draft', 'pending')
+                   AND tx.create_date < %s
+                 ORDER BY ipn.id
+                 LIMIT %s
+                   FOR UPDATE OF ipn SKIP LOCKED
+            """, (last_id, limit, batch_size))
+            rows = [(ipn_id, tx_id, json.loads(data)) for ipn_id, tx_id, data in cr.fetchall()]
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            start = time.time()
+            stats = self._moneris_reconcile_batch(cr, uid, rows, workers=workers, context=context)
+            # releases the claimed rows and the reference locks
+            cr.commit()
+            _logger.info(
+                'Moneris reconciliation: batch of %(processed)s transactions in %(duration).2fs: '
+                '%(validated)s validated, %(invalid)s invalid, %(failed)s failed, '
+                '%(skipped)s skipped (callback in progress)',
+                dict(stats, duration=time.time() - start))
+            for key in totals:
+                totals[key] += stats[key]
+        cr.execute("""
+            SELECT count(*)
+              FROM payment_transaction tx
+              JOIN payment_acquirer acquirer ON acquirer.id = tx.acquirer_id
+             WHERE acquirer.provider = 'moneris'
+               AND tx.state IN ('draft', 'pending')
+               AND tx.create_date < %s
+               AND NOT EXISTS (SELECT 1 FROM payment_moneris_ipn ipn
+                                WHERE ipn.reference = tx.reference AND ipn.state != 'done')
+        """, (limit,))
+        totals['unverifiable'] = cr.fetchone()[0]
+        _logger.info(
+            'Moneris reconciliation done: %(processed)s transactions, %(validated)s validated, '
+            '%(invalid)s invalid, %(failed)s failed, %(skipped)s skipped (callback in progress), '
+            '%(unverifiable)s without callback data', totals)
+        return totals
 
     # --------------------------------------------------
     # SERVER2SERVER RELATED METHODS
     # --------------------------------------------------
 
-    def _moneris_try_url(self, request, tries=3, context=None):
+    def _moneris_try_url(self, request, tries=3, environment=None, renew_token=None, context=None):
         """ Try to contact Moneris. Due to some issues, internal service errors
         seem to be quite frequent. Several tries are done before considering
         the communication as failed.
 
+        Requests go through the configured transport, by default the keep-alive
+        connection pool of ``environment``.
+        Server errors and network failures are retried with an exponential
+        backoff with full jitter (``moneris_retry_backoff`` seconds, doubled
+        at each try), as long as the total ``moneris_retry_deadline`` is not
+        exceeded; the socket timeouts of each try are capped to the time left.
+        Failures are reported to the environment circuit breaker;
+        while it is open, calls fail immediately.
+
+        Client errors (4xx) are not retried: their body is returned as is.
+        The exception is a 401 with ``renew_token``, a callable returning a new
+        access token in place of the rejected one: the request is then sent
+        again once with the new token.
+        POST requests (payments, captures, refunds, vault) are not idempotent:
+        once sent, they are only retried on server errors (5xx), never after a
+        network failure or timeout, which would risk doing them twice.
+
+        :raise openerp.exceptions.Warning: if Moneris could not be reached
+
          .. versionadded:: pre-v8 saas-3
          .. warning::
 
             Experimental code. You should not use it before OpenERP v8 official
             release.
         """
-        done, res = False, None
-        while (not done and tries):
+        breaker = get_breaker(environment)
+        if not breaker.allow():
+            _logger.warning('Moneris %s API unavailable (circuit open), not contacting it', environment)
+            raise Warning(_('The payment service is temporarily unavailable, please try again in a few minutes.'))
+
+        backoff = float(config.get('moneris_retry_backoff') or 0.5)
+        deadline = time.time() + float(config.get('moneris_retry_deadline') or 30)
+        idempotent = request.get_method() != 'POST'
+        attempt = 0
+        renewed = False
+        while True:
+            attempt += 1
+            error = None
             try:
-                res = urllib2.urlopen(request)
-                done = True
+                with metrics.registry.timer('moneris_rest_seconds', {'environment': environment, 'call': 'api'}):
+                    # the socket timeouts must not overrun the retry deadline
+                    res = transport.urlopen(environment, request, timeout=max(deadline - time.time(), 1.0))
+                breaker.record_success()
+                return res.read()
             except urllib2.HTTPError as e:
-                res = e.read()
+                body = e.read()
                 e.close()
-                if tries and res and json.loads(res)['name'] == 'INTERNAL_SERVICE_ERROR':
-                    _logger.warning('Failed contacting Moneris, retrying (%s remaining)' % tries)
-            tries = tries - 1
-        if not res:
-            pass
-            # raise openerp.exceptions.
-        result = res.read()
-        res.close()
-        return result
+                if e.code == 401 and renew_token and not renewed:
+                    # the cached token was revoked or expired early: nothing was processed
+                    breaker.record_success()
+                    renewed = True
+                    rejected = request.get_header('Authorization', '')[len('Bearer '):]
+                    request.add_header('Authorization', 'Bearer %s' % renew_token(rejected))
+                    attempt -= 1
+                    continue
+                if e.code < 500:
+                    breaker.record_success()
+                    return body
+                error = 'HTTP %s %s' % (e.code, body[:200])
+            except (urllib2.URLError, httplib.HTTPException, socket.error) as e:
+                error = e
+                if not idempotent and not isinstance(e, connection.ConnectError):
+                    # the request may have been processed, the answer was lost
+                    breaker.record_failure()
+                    _logger.warning('Moneris did not answer %s %s: %s', request.get_method(), request.get_full_url(), e)
+                    raise Warning(_('The payment service did not answer in time. The operation may have been '
+                                    'processed: check its status before trying again.'))
+            except Exception:
+                # do not leave a half-open breaker waiting for this probe
+                breaker.record_failure()
+                raise
+            breaker.record_failure()
+            delay = random.uniform(0, backoff * 2 ** (attempt - 1))
+            if attempt >= tries or time.time() + delay > deadline or not breaker.allow():
+                _logger.warning('Failed contacting Moneris after %s tries: %s', attempt, error)
+                raise Warning(_('The payment service is temporarily unavailable, please try again in a few minutes.'))
+            _logger.warning('Failed contacting Moneris (%s), retrying in %.2fs (%s remaining)', error, delay, tries - attempt)
+            metrics.registry.inc('moneris_retries_total', {'environment': environment})
+            time.sleep(delay)
+
+    def _moneris_s2s_post_payment(self, cr, uid, tx, payment, tries=3, context=None):
+        """ Create the Rest API sale payment of ``tx``. ``payment`` holds the
+        payer (and redirect URLs) of the request. Return the raw answer. """
+        acquirer = self.pool['payment.acquirer']._moneris_get_config(cr, uid, tx.acquirer_id.id)
+        access_token = self.pool['payment.acquirer']._moneris_s2s_get_access_token(
+            cr, uid, [acquirer.id], context=context)[acquirer.id]
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': 'Bearer %s' % access_token,
+        }
+        data = dict(payment, intent='sale', transactions=[{
+            'amount': {
+                'total': '%.2f' % tx.amount,
+                'currency': tx.currency_id.name,
+            },
+            'description': tx.reference,
+        }])
+        request = urllib2.Request('%s/payments/payment' % acquirer.api_url, json.dumps(data), headers)
+        renew_token = partial(self.pool['payment.acquirer']._moneris_s2s_renew_access_token,
+                              cr, uid, acquirer.id, context=context)
+        return self._moneris_try_url(request, tries=tries, environment=acquirer.environment,
+                                     renew_token=renew_token, context=context)
+
+    def _moneris_s2s_token_payer(self, cr, uid, token, context=None):
+        return {
+            'payment_method': 'credit_card',
+            'funding_instruments': [{
+                'credit_card_token': {
+                    'credit_card_id': token.data_key,
+                    'external_customer_id': str(token.partner_id.id),
+                },
+            }],
+        }
 
     def _moneris_s2s_send(self, cr, uid, values, cc_values, context=None):
-        """
+        """ With ``moneris_store_card`` in the context, the card is stored in
+        the Vault first and paid with its data key, so that the partner can
+        pay with ``moneris_s2s_charge_token`` next time.
+
          .. versionadded:: pre-v8 saas-3
          .. warning::
 
@@ -326,21 +1070,14 @@ class TxMoneris(osv.Model):
         tx_id = self.create(cr, uid, values, context=context)
         tx = self.browse(cr, uid, tx_id, context=context)
 
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': 'Bearer %s' % tx.acquirer_id._moneris_s2s_get_access_token()[tx.acquirer_id.id],
-        }
-        data = {
-            'intent': 'sale',
-            'transactions': [{
-                'amount': {
-                    'total': '%.2f' % tx.amount,
-                    'currency': tx.currency_id.name,
-                },
-                'description': tx.reference,
-            }]
-        }
-        if cc_values:
+        data = {}
+        if cc_values and (context or {}).get('moneris_store_card'):
+            Token = self.pool['payment.moneris.token']
+            token_id = Token.moneris_register_card(
+                cr, uid, tx.acquirer_id.id, tx.partner_id.id, cc_values, context=context)
+            data['payer'] = self._moneris_s2s_token_payer(
+                cr, uid, Token.browse(cr, uid, token_id, context=context), context=context)
+        elif cc_values:
             data['payer'] = {
                 'payment_method': 'credit_card',
                 'funding_instruments': [{
@@ -370,12 +1107,32 @@ class TxMoneris(osv.Model):
             data['payer'] = {
                 'payment_method': 'moneris',
             }
-        data = json.dumps(data)
 
-        request = urllib2.Request('https://api.sandbox.moneris.com/v1/payments/payment', data, headers)
-        result = self._moneris_try_url(request, tries=3, context=context)
+        result = self._moneris_s2s_post_payment(cr, uid, tx, data, tries=3, context=context)
         return (tx_id, result)
 
+    def moneris_s2s_charge_token(self, cr, uid, token_id, values, context=None):
+        """ Pay with a card stored in the Vault, in a single server-side
+        request: create the transaction from ``values`` (reference, amount,
+        currency_id...), charge the data key of ``token_id`` and validate the
+        transaction with the answer.
+
+        The charge is not retried, so that a timeout can never lead to paying
+        twice.
+
+        :return: ``(tx_id, validated)``
+        """
+        token = self.pool['payment.moneris.token'].browse(cr, uid, token_id, context=context)
+        if not token.active:
+            raise Warning(_('This card is no longer available.'))
+        tx_values = self.on_change_partner_id(cr, uid, None, token.partner_id.id, context=context)['values']
+        tx_values.update(values, acquirer_id=token.acquirer_id.id, partner_id=token.partner_id.id)
+        tx_id = self.create(cr, uid, tx_values, context=context)
+        tx = self.browse(cr, uid, tx_id, context=context)
+        payer = self._moneris_s2s_token_payer(cr, uid, token, context=context)
+        result = self._moneris_s2s_post_payment(cr, uid, tx, {'payer': payer}, tries=1, context=context)
+        return tx_id, self._moneris_s2s_validate(cr, uid, tx, result, context=context)
+
     def _moneris_s2s_get_invalid_parameters(self, cr, uid, tx, data, context=None):
         """
          .. versionadded:: pre-v8 saas-3
@@ -397,32 +1154,52 @@ class TxMoneris(osv.Model):
         """
         values = json.loads(data)
         status = values.get('state')
-        if status in ['approved']:
+        operation = (context or {}).get('moneris_s2s_operation')
+        if operation == 'refund':
+            return self._moneris_s2s_validate_refund(cr, uid, tx, values, context=context)
+        # a capture has its own id, the authorization one is kept
+        id_field = 'moneris_capture_id' if operation == 'capture' else 'moneris_txn_id'
+        if values.get('id'):
+            # kept even when the state change is refused, e.g. a capture still
+            # pending on a transaction already done: refunds go through it
+            self._moneris_write_changes(cr, uid, tx, {id_field: values['id']}, context=context)
+        if status in ['approved', 'completed']:
             _logger.info('Validated Moneris s2s payment for tx %s: set as done' % (tx.reference))
-            tx.write({
+            self._moneris_write_changes(cr, uid, tx, {
                 'state': 'done',
                 'date_validate': values.get('udpate_time', fields.datetime.now()),
-                'moneris_txn_id': values['id'],
-            })
+            }, context=context)
             return True
         elif status in ['pending', 'expired']:
             _logger.info('Received notification for Moneris s2s payment %s: set as pending' % (tx.reference))
-            tx.write({
+            self._moneris_write_changes(cr, uid, tx, {
                 'state': 'pending',
                 # 'state_message': data.get('pending_reason', ''),
-                'moneris_txn_id': values['id'],
-            })
+            }, context=context)
             return True
         else:
             error = 'Received unrecognized status for Moneris s2s payment %s: %s, set as error' % (tx.reference, status)
             _logger.info(error)
-            tx.write({
+            self._moneris_write_changes(cr, uid, tx, {
                 'state': 'error',
                 # 'state_message': error,
-                'moneris_txn_id': values['id'],
-            })
+            }, context=context)
             return False
 
+    def _moneris_s2s_validate_refund(self, cr, uid, tx, values, context=None):
+        """ Apply the answer to a refund of ``tx``. A refused refund leaves
+        the (still paid) transaction untouched. """
+        status = values.get('state')
+        if status in ['completed', 'pending']:
+            _logger.info('Moneris s2s refund %s of tx %s %s: set as cancel', values.get('id'), tx.reference, status)
+            self._moneris_write_changes(cr, uid, tx, {
+                'state': 'cancel',
+                'state_message': 'Refund %s: %s' % (values.get('id'), status),
+            }, context=context)
+            return True
+        _logger.warning('Moneris s2s refund of tx %s refused: %s', tx.reference, values.get('message') or status)
+        return False
+
     def _moneris_s2s_get_tx_status(self, cr, uid, tx, context=None):
         """
          .. versionadded:: pre-v8 saas-3
@@ -436,7 +1213,232 @@ class TxMoneris(osv.Model):
             'Content-Type': 'application/json',
             'Authorization': 'Bearer %s' % tx.acquirer_id._moneris_s2s_get_access_token()[tx.acquirer_id.id],
         }
-        url = 'https://api.sandbox.moneris.com/v1/payments/payment/%s' % (tx.moneris_txn_id)
+        api_url = self.pool['payment.acquirer']._moneris_get_config(cr, uid, tx.acquirer_id.id).api_url
+        url = '%s/payments/payment/%s' % (api_url, tx.moneris_txn_id)
         request = urllib2.Request(url, headers=headers)
-        data = self._moneris_try_url(request, tries=3, context=context)
+        renew_token = partial(self.pool['payment.acquirer']._moneris_s2s_renew_access_token,
+                              cr, uid, tx.acquirer_id.id, context=context)
+        data = self._moneris_try_url(request, tries=3, environment=tx.acquirer_id.environment,
+                                     renew_token=renew_token, context=context)
         return self.s2s_feedback(cr, uid, tx.id, data, context=context)
+
+    # --------------------------------------------------
+    # SERVER2SERVER BATCH OPERATIONS
+    # --------------------------------------------------
+
+    def _moneris_s2s_batch(self, cr, uid, ids, operation, chunk_size=100, workers=8, context=None):
+        """ Submit ``operation`` (``capture`` or ``refund``) for many transactions.
+
+        One access token is fetched per acquirer for the whole batch, and the
+        requests are sent with at most ``workers`` concurrent calls. Answers
+        go through ``_moneris_s2s_validate`` and are committed every
+        ``chunk_size`` transactions. A failing transaction is reported and
+        does not abort the others.
+
+        ``moneris_txn_id`` must hold the Moneris id of the authorization (for
+        captures) or of the sale (for refunds). Captured authorizations are
+        refunded through their capture (``moneris_capture_id``).
+
+        Transactions the operation was already done for (captured, or
+        refunded thus cancelled) or cannot apply to are skipped, so that a
+        batch can safely be run again.
+
+        :return: dict {tx_id: (success, message)}, success being None for
+                 skipped transactions
+        """
+        assert operation in ('capture', 'refund')
+        Acquirer = self.pool['payment.acquirer']
+        txs = self.browse(cr, uid, ids, context=context)
+        results = {}
+        acquirer_ids = list(set(tx.acquirer_id.id for tx in txs))
+        tokens = Acquirer._moneris_s2s_get_access_token(cr, uid, acquirer_ids, context=context)
+
+        jobs = []
+        for tx in txs:
+            if not tx.moneris_txn_id:
+                results[tx.id] = (False, 'no Moneris transaction id')
+                continue
+            skipped = self._moneris_s2s_batch_skip(cr, uid, tx, operation, context=context)
+            if skipped:
+                results[tx.id] = (None, skipped)
+                continue
+            acquirer = Acquirer._moneris_get_config(cr, uid, tx.acquirer_id.id)
+            if operation == 'capture':
+                path = 'authorization/%s/capture' % tx.moneris_txn_id
+            elif tx.moneris_capture_id:
+                path = 'capture/%s/refund' % tx.moneris_capture_id
+            else:
+                path = 'sale/%s/refund' % tx.moneris_txn_id
+            payload = {'amount': {'total': '%.2f' % tx.amount, 'currency': tx.currency_id.name}}
+            if operation == 'capture':
+                payload['is_final_capture'] = True
+            request = urllib2.Request(
+                '%s/payments/%s' % (acquirer.api_url, path), json.dumps(payload), {
+                    'Content-Type': 'application/json',
+                    'Authorization': 'Bearer %s' % tokens[acquirer.id],
+                })
+            jobs.append((tx.id, acquirer, request))
+
+        def submit(job):
+            tx_id, acquirer, request = job
+            renew_token = partial(Acquirer._moneris_s2s_renew_access_token, cr, uid, acquirer.id, context=context)
+            try:
+                return tx_id, self._moneris_try_url(request, tries=3, environment=acquirer.environment,
+                                                    renew_token=renew_token, context=context), None
+            except Exception as e:
+                return tx_id, None, e
+
+        answers = concurrent_map(submit, jobs, workers)
+        validate_context = dict(context or {}, moneris_s2s_operation=operation)
+        for start in range(0, len(answers), chunk_size):
+            for tx_id, data, error in answers[start:start + chunk_size]:
+                if error is not None:
+                    results[tx_id] = (False, '%s' % error)
+                    continue
+                tx = self.browse(cr, uid, tx_id, context=context)
+                try:
+                    with cr.savepoint():
+                        ok = self._moneris_s2s_validate(cr, uid, tx, data, context=validate_context)
+                    results[tx_id] = (bool(ok), '' if ok else data)
+                except Exception as e:
+                    results[tx_id] = (False, '%s' % e)
+            cr.commit()
+
+        failed = [tx_id for tx_id, (ok, dummy) in results.items() if ok is False]
+        skipped = [tx_id for tx_id, (ok, dummy) in results.items() if ok is None]
+        _logger.info('Moneris s2s %s batch: %s transactions, %s failed, %s skipped',
+                     operation, len(ids), len(failed), len(skipped))
+        for tx_id in failed:
+            _logger.warning('Moneris s2s %s failed for tx %s: %s', operation, tx_id, results[tx_id][1])
+        return results
+
+    def _moneris_s2s_batch_skip(self, cr, uid, tx, operation, context=None):
+        """ Return why ``operation`` must not be submitted for ``tx``, or None. """
+        if operation == 'capture':
+            if tx.moneris_capture_id:
+                return 'already captured'
+            if tx.state in ('cancel', 'error'):
+                return 'transaction %s' % tx.state
+        elif tx.state == 'cancel':
+            return 'already refunded or cancelled'
+        elif tx.state != 'done':
+            return 'not paid'
+        return None
+
+    def moneris_s2s_capture_batch(self, cr, uid, ids, chunk_size=100, workers=8, context=None):
+        """ Capture the pre-authorized amount of many transactions. """
+        return self._moneris_s2s_batch(cr, uid, ids, 'capture', chunk_size=chunk_size, workers=workers, context=context)
+
+    def moneris_s2s_refund_batch(self, cr, uid, ids, chunk_size=100, workers=8, context=None):
+        """ Refund many paid transactions in full. """
+        return self._moneris_s2s_batch(cr, uid, ids, 'refund', chunk_size=chunk_size, workers=workers, context=context)
+
+    # Rest API payment states after which a pending payment will never go through
+    _moneris_s2s_failed_states = ('failed', 'denied', 'canceled')
+
+    def _moneris_poll_interval(self, age):
+        """ Seconds to wait before polling again a transaction created ``age``
+        seconds ago: a tenth of its age, between one minute and one hour. """
+        return min(3600, max(60, age / 10))
+
+    def moneris_s2s_poll_pending(self, cr, uid, batch_size=200, workers=8, context=None):
+        """ Cron entry point: check the status of pending server-to-server
+        transactions whose next poll is due, ``batch_size`` at a time.
+
+        Recent transactions are polled often and older ones less and less
+        (see ``_moneris_poll_interval``). Statuses are fetched concurrently
+        with one access token per acquirer, and state changes go through
+        ``_moneris_write_changes`` on the locked row.
+        """
+        Acquirer = self.pool['payment.acquirer']
+        now = datetime.utcnow()
+        cr.execute("""
+            SELECT tx.id
+              FROM payment_transaction tx
+              JOIN payment_acquirer acquirer ON acquirer.id = tx.acquirer_id
+             WHERE acquirer.provider = 'moneris'
+               AND tx.state = 'pending'
+               AND tx.moneris_txn_id IS NOT NULL
+               AND (tx.moneris_next_poll IS NULL OR tx.moneris_next_poll <= %s)
+             ORDER BY tx.moneris_next_poll NULLS FIRST, tx.id
+             LIMIT %s
+        """, (now.strftime(DEFAULT_SERVER_DATETIME_FORMAT), batch_size))
+        ids = [row[0] for row in cr.fetchall()]
+        if not ids:
+            return True
+
+        txs = self.browse(cr, uid, ids, context=context)
+        tokens = Acquirer._moneris_s2s_get_access_token(cr, uid, list(set(tx.acquirer_id.id for tx in txs)), context=context)
+        jobs = []
+        for tx in txs:
+            acquirer = Acquirer._moneris_get_config(cr, uid, tx.acquirer_id.id)
+            request = urllib2.Request('%s/payments/payment/%s' % (acquirer.api_url, tx.moneris_txn_id), headers={
+                'Content-Type': 'application/json',
+                'Authorization': 'Bearer %s' % tokens[acquirer.id],
+            })
+            jobs.append((tx.id, acquirer, request))
+
+        def poll(job):
+            tx_id, acquirer, request = job
+            renew_token = partial(Acquirer._moneris_s2s_renew_access_token, cr, uid, acquirer.id, context=context)
+            try:
+                return tx_id, json.loads(self._moneris_try_url(request, tries=1, environment=acquirer.environment,
+                                                               renew_token=renew_token, context=context))
+            except Exception as e:
+                _logger.warning('Moneris: could not poll status of tx %s: %s', tx_id, e)
+                return tx_id, None
+
+        by_state = {'done': [], 'error': []}
+        for tx_id, values in concurrent_map(poll, jobs, workers):
+            status = values and values.get('state')
+            if status in ('approved', 'completed'):
+                by_state['done'].append(tx_id)
+            elif status in self._moneris_s2s_failed_states:
+                by_state['error'].append(tx_id)
+            elif values and status not in ('pending', 'expired', 'created'):
+                # e.g. a 4xx answer (expired token, unknown payment): poll again later
+                _logger.warning('Moneris: unexpected status answer for tx %s, polling again later: %s',
+                                tx_id, values.get('message') or status)
+        # each change goes through the state machine, on the locked current
+        # row; transactions a callback or another writer holds are skipped
+        # and polled again later
+        Callback = self.pool['payment.moneris.callback']
+        targets = dict((tx_id, state) for state, tx_ids in by_state.items() for tx_id in tx_ids)
+        skipped = set()
+        for tx in txs:
+            state = targets.get(tx.id)
+            if not state:
+                continue
+            if not Callback.lock_reference(cr, uid, tx.reference, context=context):
+                skipped.add(tx.id)
+                continue
+            try:
+                with mute_logger('openerp.sql_db'), cr.savepoint():
+                    cr.execute("SELECT state FROM payment_transaction WHERE id = %s FOR UPDATE NOWAIT", (tx.id,))
+                    if cr.fetchone()[0] != tx.state:
+                        skipped.add(tx.id)
+                        continue
+                    values = {'state': state}
+                    if state == 'done':
+                        values['date_validate'] = fields.datetime.now()
+                    self._moneris_write_changes(cr, uid, tx, values, context=context)
+            except psycopg2.OperationalError:
+                # locked, or changed since the beginning of the transaction
+                skipped.add(tx.id)
+        polled = [tx for tx in txs if tx.id not in skipped]
+
+        # schedule the next poll of the transactions still pending
+        next_polls = []
+        for tx in polled:
+            created = datetime.strptime(tx.create_date[:19], DEFAULT_SERVER_DATETIME_FORMAT)
+            delay = self._moneris_poll_interval((now - created).total_seconds())
+            next_polls.append((now + timedelta(seconds=delay)).strftime(DEFAULT_SERVER_DATETIME_FORMAT))
+        cr.execute("""
+            UPDATE payment_transaction tx
+               SET moneris_next_poll = polls.next_poll
+              FROM unnest(%s::int[], %s::timestamp[]) AS polls(id, next_poll)
+             WHERE tx.id = polls.id
+        """, ([tx.id for tx in polled], next_polls))
+        _logger.info('Moneris: polled %s pending transactions: %s done, %s error, %s skipped',
+                     len(ids), len(set(by_state['done']) - skipped), len(set(by_state['error']) - skipped), len(skipped))
+        return True
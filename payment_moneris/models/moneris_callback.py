@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+from datetime import datetime, timedelta
+
+import psycopg2
+
+from openerp import SUPERUSER_ID
+from openerp.osv import osv, fields
+from openerp.tools import config, lru, mute_logger, DEFAULT_SERVER_DATETIME_FORMAT
+
+_logger = logging.getLogger(__name__)
+
+# (dbname, transactionKey, response_order_id) -> verdict
+_verdicts = lru.LRU(int(config.get('moneris_callback_cache_size') or 4096))
+
+# first key of the advisory locks taken on transaction references
+LOCK_NAMESPACE = 0x4d4f4e
+# first key of the advisory locks counting the verifications in progress
+SLOT_NAMESPACE = 0x4d4f4f
+
+
+class MonerisCallback(osv.Model):
+    """ Verdict of each Moneris callback already processed, so that the IPN,
+    the DPN and any retry of the same payment are verified only once. """
+    _name = 'payment.moneris.callback'
+    _description = 'Moneris Processed Callback'
+    _log_access = False
+    _order = 'date desc'
+
+    _columns = {
+        'transaction_key': fields.char('Transaction Key', required=True, readonly=True),
+        'order_id': fields.char('Order ID', required=True, readonly=True),
+        'transaction_id': fields.many2one('payment.transaction', 'Transaction', ondelete='cascade', readonly=True),
+        'verdict': fields.boolean('Validated', readonly=True),
+        'date': fields.datetime('Date', required=True, readonly=True),
+    }
+
+    _defaults = {
+        'date': fields.datetime.now,
+    }
+
+    _sql_constraints = [
+        ('callback_uniq', 'unique(transaction_key, order_id)', 'A Moneris callback can only be processed once.'),
+    ]
+
+    def get_verdict(self, cr, uid, transaction_key, order_id, context=None):
+        """ Return the stored verdict of a callback, or None if it was never
+        processed. """
+        if not transaction_key or not order_id:
+            return None
+        key = (cr.dbname, transaction_key, order_id)
+        verdict = _verdicts.get(key)
+        if verdict is not None:
+            return verdict
+        cr.execute("""
+            SELECT verdict FROM payment_moneris_callback
+             WHERE transaction_key = %s AND order_id = %s
+        """, (transaction_key, order_id))
+        row = cr.fetchone()
+        if not row:
+            return None
+        verdict = _verdicts[key] = bool(row[0])
+        return verdict
+
+    def lock_reference(self, cr, uid, reference, context=None):
+        """ Try to take, for the current transaction, the advisory lock of the
+        callbacks of ``reference``. Unlike a row lock it does not conflict
+        with other writers of the transaction row, and failing to get it
+        does not abort the transaction. """
+        cr.execute("SELECT pg_try_advisory_xact_lock(%s, hashtext(%s))", (LOCK_NAMESPACE, reference))
+        return cr.fetchone()[0]
+
+    def take_verification_slot(self, cr, uid, context=None):
+        """ Try to take, for the current transaction, one of the
+        ``moneris_max_inflight`` verification slots shared by all the server
+        processes using the database. Always succeeds when no limit is set. """
+        slots = int(config.get('moneris_max_inflight') or 0)
+        if slots <= 0:
+            return True
+        cr.execute("""
+            SELECT slot FROM generate_series(0, %s - 1) slot
+             WHERE pg_try_advisory_xact_lock(%s, slot)
+             LIMIT 1
+        """, (slots, SLOT_NAMESPACE))
+        return bool(cr.fetchone())
+
+    def get_committed_verdict(self, cr, uid, transaction_key, order_id, reference=None, wait=0, context=None):
+        """ Return the verdict committed by another transaction, waiting up to
+        ``wait`` seconds for it to appear. A separate cursor is used, as the
+        current transaction snapshot may predate that commit.
+
+        If no verdict shows up and ``reference`` is given, return whether the
+        transaction is done; otherwise return None. """
+        deadline = time.time() + wait
+        with self.pool.cursor() as verdict_cr:
+            while True:
+                verdict_cr.execute("""
+                    SELECT verdict FROM payment_moneris_callback
+                     WHERE transaction_key = %s AND order_id = %s
+                """, (transaction_key, order_id))
+                row = verdict_cr.fetchone()
+                if row:
+                    verdict = _verdicts[(cr.dbname, transaction_key, order_id)] = bool(row[0])
+                    return verdict
+                if time.time() >= deadline:
+                    break
+                # new snapshot for the next look
+                verdict_cr.rollback()
+                time.sleep(0.1)
+            if reference is None:
+                return None
+            verdict_cr.execute("SELECT state FROM payment_transaction WHERE reference = %s", (reference,))
+            row = verdict_cr.fetchone()
+            return bool(row and row[0] == 'done')
+
+    def record_verdict(self, cr, uid, transaction_key, order_id, verdict, tx_id=False, context=None):
+        """ Store the verdict of a verified callback. If a concurrent callback
+        stored one first, keep and return that one. """
+        if not transaction_key or not order_id:
+            return verdict
+        try:
+            with mute_logger('openerp.sql_db'), cr.savepoint():
+                self.create(cr, SUPERUSER_ID, {
+                    'transaction_key': transaction_key,
+                    'order_id': order_id,
+                    'transaction_id': tx_id,
+                    'verdict': bool(verdict),
+                }, context=context)
+        except psycopg2.IntegrityError:
+            _logger.info('Moneris: callback %s/%s already processed', order_id, transaction_key)
+            return self.get_verdict(cr, uid, transaction_key, order_id, context=context)
+        # not cached yet: the transaction may still roll back, the verdict is
+        # cached when read back once committed
+        return verdict
+
+    def _gc_callbacks(self, cr, uid, days=30, context=None):
+        """ Drop the verdicts older than ``days``; Moneris does not retry
+        notifications that late. """
+        limit = (datetime.utcnow() - timedelta(days=days)).strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+        cr.execute("DELETE FROM payment_moneris_callback WHERE date < %s", (limit,))
+        _logger.info('Moneris: removed %s processed callbacks older than %s days', cr.rowcount, days)
+        return True
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+import logging
+import threading
+from datetime import datetime, timedelta
+
+import openerp
+from openerp import api, SUPERUSER_ID
+from openerp.osv import osv, fields
+from openerp.tools import config, DEFAULT_SERVER_DATETIME_FORMAT
+
+_logger = logging.getLogger(__name__)
+
+# result of a callback queued to be verified in the background
+QUEUED = 'queued'
+
+
+def _config_flag(name):
+    return str(config.get(name) or '').lower() in ('1', 'true', 'yes', 'on')
+
+
+class MonerisIpnQueue(osv.Model):
+    """ Durable intake queue of Moneris IPN notifications.
+
+    When ``moneris_ipn_async`` is enabled in the server configuration, the
+    IPN route only stores the raw POST data here and answers right away. The
+    queue is then processed by a cron: each run starts ``moneris_ipn_workers``
+    threads that claim rows one at a time with ``FOR UPDATE SKIP LOCKED``,
+    verify them with Moneris and feed them to ``form_feedback``. Failed rows
+    are retried with an exponential backoff, and dead-lettered after
+    ``moneris_ipn_max_attempts`` attempts.
+    """
+    _name = 'payment.moneris.ipn'
+    _description = 'Moneris IPN Queue'
+    _order = 'id'
+
+    _columns = {
+        'data': fields.text('POST Data', required=True, readonly=True),
+        'reference': fields.char('Reference', readonly=True, select=True),
+        'transaction_key': fields.char('Transaction Key', readonly=True),
+        'order_id': fields.char('Order ID', readonly=True),
+        'state': fields.selection([
+            ('pending', 'Pending'),
+            ('done', 'Done'),
+            ('dead', 'Dead'),
+        ], 'Status', required=True, readonly=True, select=True),
+        'attempts': fields.integer('Attempts', readonly=True),
+        'next_attempt': fields.datetime('Next Attempt', readonly=True),
+        'last_error': fields.text('Last Error', readonly=True),
+        'verdict': fields.boolean('Validated', readonly=True),
+    }
+
+    _defaults = {
+        'state': 'pending',
+        'attempts': 0,
+    }
+
+    def _auto_init(self, cr, context=None):
+        res = super(MonerisIpnQueue, self)._auto_init(cr, context=context)
+        # a callback waits in the queue once, see enqueue
+        cr.execute("SELECT 1 FROM pg_class WHERE relname = 'payment_moneris_ipn_callback_uniq'")
+        if not cr.fetchone():
+            cr.execute("""
+                CREATE UNIQUE INDEX payment_moneris_ipn_callback_uniq
+                    ON payment_moneris_ipn (transaction_key, order_id) WHERE state != 'done'
+            """)
+        return res
+
+    def is_async(self, cr, uid, context=None):
+        return _config_flag('moneris_ipn_async')
+
+    def is_full(self, cr, uid, context=None):
+        """ Whether ``moneris_ipn_max_pending`` IPNs (10000 by default) are
+        waiting in the queue. """
+        limit = int(config.get('moneris_ipn_max_pending') or 10000)
+        cr.execute("""
+            SELECT count(*) >= %s FROM (SELECT 1 FROM payment_moneris_ipn WHERE state = 'pending' LIMIT %s) pending
+        """, (limit, limit))
+        return cr.fetchone()[0]
+
+    def enqueue(self, cr, uid, post, context=None):
+        """ Store an IPN for later processing; no other work is done. An IPN
+        already waiting in the queue (same transactionKey and
+        response_order_id) is not stored again.
+
+        :return: the id of the queued IPN, or None if it was already queued
+        """
+        cr.execute("""
+            INSERT INTO payment_moneris_ipn (data, reference, transaction_key, order_id, state, attempts,
+                                             create_uid, create_date, write_uid, write_date)
+            VALUES (%s, %s, %s, %s, 'pending', 0, %s, now() at time zone 'UTC', %s, now() at time zone 'UTC')
+                ON CONFLICT (transaction_key, order_id) WHERE state != 'done' DO NOTHING
+            RETURNING id
+        """, (json.dumps(post), post.get('rvaroid'), post.get('transactionKey'), post.get('response_order_id'),
+              uid, uid))
+        row = cr.fetchone()
+        return row and row[0]
+
+    def _claim_one(self, cr):
+        cr.execute("""
+            SELECT id, data, attempts FROM payment_moneris_ipn
+             WHERE state = 'pending'
+               AND (next_attempt IS NULL OR next_attempt <= now() at time zone 'UTC')
+             ORDER BY id
+             LIMIT 1
+               FOR UPDATE SKIP LOCKED
+        """)
+        return cr.fetchone()
+
+    def _process_one(self, cr, uid, context=None):
+        """ Claim and process a single queued IPN in the current transaction.
+
+        :return: False if there was nothing to claim, True otherwise
+        """
+        row = self._claim_one(cr)
+        if not row:
+            return False
+        ipn_id, data, attempts = row
+        attempts += 1
+        max_attempts = int(config.get('moneris_ipn_max_attempts') or 5)
+        try:
+            with cr.savepoint():
+                verdict = self.pool['payment.transaction']._moneris_verify_data(
+                    cr, uid, json.loads(data), context=dict(context or {}, moneris_ipn_queued=True))
+        except Exception as e:
+            state = 'dead' if attempts >= max_attempts else 'pending'
+            delay = timedelta(minutes=2 ** attempts)
+            _logger.warning('Moneris: IPN %s failed (attempt %s/%s): %s', ipn_id, attempts, max_attempts, e)
+            cr.execute("""
+                UPDATE payment_moneris_ipn
+                   SET state = %s, attempts = %s, last_error = %s, next_attempt = %s,
+                       write_date = now() at time zone 'UTC'
+                 WHERE id = %s
+            """, (state, attempts, '%s' % e,
+                  (datetime.utcnow() + delay).strftime(DEFAULT_SERVER_DATETIME_FORMAT), ipn_id))
+        else:
+            cr.execute("""
+                UPDATE payment_moneris_ipn
+                   SET state = 'done', attempts = %s, last_error = NULL, verdict = %s,
+                       write_date = now() at time zone 'UTC'
+                 WHERE id = %s
+            """, (attempts, bool(verdict), ipn_id))
+        return True
+
+    def _worker(self, dbname, limit, context=None):
+        """ Body of a queue worker thread: process up to ``limit`` IPNs, each
+        one in its own short transaction. """
+        threading.current_thread().dbname = dbname
+        registry = openerp.registry(dbname)
+        processed = 0
+        with api.Environment.manage():
+            while processed < limit:
+                with registry.cursor() as cr:
+                    if not self._process_one(cr, SUPERUSER_ID, context=context):
+                        break
+                processed += 1
+        return processed
+
+    def process_queue(self, cr, uid, limit=500, workers=None, context=None):
+        """ Cron entry point: drain up to ``limit`` queued IPNs with a pool of
+        ``workers`` threads (``moneris_ipn_workers``, 2 by default). """
+        workers = workers or int(config.get('moneris_ipn_workers') or 2)
+        per_worker = max(1, (limit + workers - 1) // workers)
+        threads = [
+            threading.Thread(target=self._worker, args=(cr.dbname, per_worker, context),
+                             name='moneris.ipn.%s' % i)
+            for i in range(workers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return True
+
+    def _gc_ipn(self, cr, uid, days=7, context=None):
+        """ Drop the processed IPNs older than ``days``: they hold the raw
+        POST data, cardholder names included. Dead-lettered rows are kept
+        until they are requeued and processed. """
+        limit = (datetime.utcnow() - timedelta(days=days)).strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+        cr.execute("DELETE FROM payment_moneris_ipn WHERE state = 'done' AND write_date < %s", (limit,))
+        _logger.info('Moneris: removed %s processed IPNs older than %s days', cr.rowcount, days)
+        return True
+
+    def requeue_dead(self, cr, uid, ids, context=None):
+        """ Give dead-lettered IPNs another chance. """
+        return self.write(cr, uid, ids, {'state': 'pending', 'attempts': 0, 'next_attempt': False}, context=context)
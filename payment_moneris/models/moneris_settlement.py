@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+import logging
+from collections import defaultdict
+
+from openerp.osv import osv, fields
+
+_logger = logging.getLogger(__name__)
+
+# transaction states accounted for in the summary
+SETTLED_STATES = ('pending', 'done', 'error', 'cancel')
+
+
+class MonerisSettlement(osv.Model):
+    """ Daily totals of the Moneris transactions, by acquirer, card type,
+    currency and outcome (transaction state), the day being the UTC creation
+    day of the transactions.
+
+    Rows are updated incrementally when the validation paths change the state
+    of a transaction (see ``record_transitions``), so reports read a few
+    hundred rows instead of grouping the whole transaction table. ``rebuild``
+    recomputes them from the transactions, e.g. after a backfill.
+
+    The payment transactions do not update the rows themselves: concurrent
+    callbacks of the same day would fail to serialize their updates of the
+    same row. They only insert their changes in the
+    ``payment.moneris.settlement.delta`` log, which ``fold_deltas`` adds to
+    the rows every minute.
+    """
+    _name = 'payment.moneris.settlement'
+    _description = 'Moneris Settlement Summary'
+    _log_access = False
+    _order = 'day desc, acquirer_id, card_type, state'
+
+    def _get_states(self, cr, uid, context=None):
+        return [(state, label) for state, label in self.pool['payment.transaction']._columns['state'].selection
+                if state in SETTLED_STATES]
+
+    _columns = {
+        'day': fields.date('Day', required=True, readonly=True, select=True),
+        'acquirer_id': fields.many2one('payment.acquirer', 'Acquirer', required=True, ondelete='cascade', readonly=True),
+        'card_type': fields.char('Card Type', required=True, readonly=True),
+        'state': fields.selection(_get_states, 'Outcome', required=True, readonly=True),
+        'currency_id': fields.many2one('res.currency', 'Currency', required=True, readonly=True),
+        'count': fields.integer('Transactions', readonly=True),
+        'amount': fields.float('Amount', readonly=True),
+    }
+
+    _sql_constraints = [
+        ('settlement_uniq', 'unique(day, acquirer_id, card_type, state, currency_id)',
+         'There is a single summary row per day, acquirer, card type, outcome and currency.'),
+    ]
+
+    def record_transitions(self, cr, uid, txs, state, payloads=None, context=None):
+        """ Account for the transactions ``txs``, browsed before the change,
+        moving to ``state``. ``payloads`` holds the verification payloads
+        replacing the stored ones along with the change, by transaction id:
+        the old state is accounted under the old card type, the new state
+        under the new one. """
+        payloads = payloads or {}
+        stored = self.pool['payment.moneris.txn.data'].get_payloads(cr, uid, [tx.id for tx in txs], context=context)
+        deltas = defaultdict(lambda: [0, 0.0])
+        for tx in txs:
+            if tx.state == state:
+                continue
+            key = (tx.create_date[:10], tx.acquirer_id.id)
+            old_card = stored.get(tx.id, {}).get('Card') or ''
+            new_card = payloads.get(tx.id, stored.get(tx.id, {})).get('Card') or ''
+            if tx.state in SETTLED_STATES:
+                delta = deltas[key + (old_card, tx.currency_id.id, tx.state)]
+                delta[0] -= 1
+                delta[1] -= tx.amount
+            if state in SETTLED_STATES:
+                delta = deltas[key + (new_card, tx.currency_id.id, state)]
+                delta[0] += 1
+                delta[1] += tx.amount
+        return self._log_deltas(cr, deltas)
+
+    def _log_deltas(self, cr, deltas):
+        """ Log ``(count, amount)`` to add to the rows keyed by ``(day,
+        acquirer_id, card_type, currency_id, state)`` in ``deltas``. Inserts
+        only, which never conflict with concurrent transactions. """
+        for (day, acquirer_id, card_type, currency_id, row_state), (count, amount) in sorted(deltas.items()):
+            if not count and not amount:
+                continue
+            cr.execute("""
+                INSERT INTO payment_moneris_settlement_delta (day, acquirer_id, card_type, currency_id, state, count, amount)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+            """, (day, acquirer_id, card_type, currency_id, row_state, count, amount))
+        return True
+
+    def _fold_deltas(self, cr, limit=10000):
+        """ Move up to ``limit`` logged deltas into the summary rows.
+
+        :return: the number of deltas folded
+        """
+        # the log is always locked before the summary, as in rebuild
+        cr.execute("""
+            WITH folded AS (
+                DELETE FROM payment_moneris_settlement_delta
+                 WHERE id IN (SELECT id FROM payment_moneris_settlement_delta
+                               ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED)
+             RETURNING day, acquirer_id, card_type, currency_id, state, count, amount
+            ), summed AS (
+                SELECT day, acquirer_id, card_type, currency_id, state, sum(count) AS count,
+                       sum(amount) AS amount, count(*) AS deltas
+                  FROM folded
+                 GROUP BY day, acquirer_id, card_type, currency_id, state
+            ), upserted AS (
+                INSERT INTO payment_moneris_settlement (day, acquirer_id, card_type, currency_id, state, count, amount)
+                SELECT day, acquirer_id, card_type, currency_id, state, count, amount
+                  FROM summed
+                 ORDER BY day, acquirer_id, card_type, currency_id, state
+                    ON CONFLICT (day, acquirer_id, card_type, state, currency_id) DO UPDATE
+                   SET count = payment_moneris_settlement.count + EXCLUDED.count,
+                       amount = payment_moneris_settlement.amount + EXCLUDED.amount
+            )
+            SELECT COALESCE(sum(deltas), 0) FROM summed
+        """, (limit,))
+        return int(cr.fetchone()[0])
+
+    def fold_deltas(self, cr, uid, limit=10000, max_batches=20, context=None):
+        """ Cron entry point: fold the logged deltas into the summary,
+        ``limit`` at a time, each batch in its own READ COMMITTED transaction
+        so that it does not fail on rows updated by a concurrent ``rebuild``. """
+        folded = 0
+        for _batch in range(max_batches):
+            with self.pool.cursor() as fold_cr:
+                fold_cr.execute("SET TRANSACTION ISOLATION LEVEL READ COMMITTED")
+                count = self._fold_deltas(fold_cr, limit)
+            folded += count
+            if count < limit:
+                break
+        _logger.info('Moneris: folded %s settlement deltas', folded)
+        return True
+
+    def rebuild(self, cr, uid, date_from=None, context=None):
+        """ Recompute the summary of the days from ``date_from`` on (all days
+        if not given) from the transactions. Callbacks logging deltas wait for
+        the end of the transaction, and the deltas of those days are dropped,
+        as the transactions account for them. """
+        cr.execute("LOCK TABLE payment_moneris_settlement_delta IN EXCLUSIVE MODE")
+        cr.execute("LOCK TABLE payment_moneris_settlement IN EXCLUSIVE MODE")
+        cr.execute("DELETE FROM payment_moneris_settlement_delta WHERE %s IS NULL OR day >= %s", (date_from, date_from))
+        cr.execute("DELETE FROM payment_moneris_settlement WHERE %s IS NULL OR day >= %s", (date_from, date_from))
+        cr.execute("""
+            INSERT INTO payment_moneris_settlement (day, acquirer_id, card_type, currency_id, state, count, amount)
+            SELECT tx.create_date::date, tx.acquirer_id, COALESCE(txn_data.data::json->>'Card', ''),
+                   tx.currency_id, tx.state, count(*), sum(tx.amount)
+              FROM payment_transaction tx
+              JOIN payment_acquirer acquirer ON acquirer.id = tx.acquirer_id AND acquirer.provider = 'moneris'
+              LEFT JOIN payment_moneris_txn_data txn_data ON txn_data.transaction_id = tx.id
+             WHERE tx.state IN %s AND (%s IS NULL OR tx.create_date >= %s)
+             GROUP BY 1, 2, 3, 4, 5
+        """, (SETTLED_STATES, date_from, date_from))
+        _logger.info('Moneris: rebuilt %s settlement summary rows', cr.rowcount)
+        return True
+
+
+class MonerisSettlementDelta(osv.Model):
+    """ Changes of the settlement summary logged by the payment transactions,
+    not yet added to ``payment.moneris.settlement`` (see ``fold_deltas``). """
+    _name = 'payment.moneris.settlement.delta'
+    _description = 'Moneris Settlement Summary Change'
+    _log_access = False
+    _order = 'id'
+
+    _columns = {
+        'day': fields.date('Day', required=True, readonly=True),
+        'acquirer_id': fields.many2one('payment.acquirer', 'Acquirer', required=True, ondelete='cascade', readonly=True),
+        'card_type': fields.char('Card Type', required=True, readonly=True),
+        'state': fields.char('Outcome', required=True, readonly=True),
+        'currency_id': fields.many2one('res.currency', 'Currency', required=True, readonly=True),
+        'count': fields.integer('Transactions', readonly=True),
+        'amount': fields.float('Amount', readonly=True),
+    }
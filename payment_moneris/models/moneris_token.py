@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+import logging
+import urllib2
+from functools import partial
+
+from openerp.exceptions import Warning
+from openerp.osv import osv, fields
+from openerp.tools.translate import _
+
+_logger = logging.getLogger(__name__)
+
+
+class MonerisToken(osv.Model):
+    """ Card of a partner stored in the Moneris Vault. Only the Vault data key
+    and a masked number are kept; payments made with the data key (see
+    ``payment.transaction.moneris_s2s_charge_token``) take a single
+    server-side request, without going through the hosted page. """
+    _name = 'payment.moneris.token'
+    _description = 'Moneris Vault Token'
+    _order = 'partner_id, id desc'
+
+    _columns = {
+        'name': fields.char('Card', required=True, readonly=True),
+        'partner_id': fields.many2one('res.partner', 'Partner', required=True, ondelete='cascade',
+                                      readonly=True, select=True),
+        'acquirer_id': fields.many2one('payment.acquirer', 'Acquirer', required=True, ondelete='cascade',
+                                       readonly=True),
+        'data_key': fields.char('Data Key', required=True, readonly=True),
+        'card_type': fields.char('Card Type', readonly=True),
+        'expiry': fields.char('Expiry', readonly=True, help='MM/YY'),
+        'active': fields.boolean('Active'),
+    }
+
+    _defaults = {
+        'active': True,
+    }
+
+    _sql_constraints = [
+        ('data_key_uniq', 'unique(acquirer_id, data_key)', 'A Vault data key can only be stored once.'),
+    ]
+
+    def moneris_register_card(self, cr, uid, acquirer_id, partner_id, cc_values, context=None):
+        """ Store a card of ``partner_id`` in the Vault of ``acquirer_id``.
+
+        :param dict cc_values: number, brand, expiry_mm, expiry_yy and cvc of the card
+        :return: the id of the created token
+        :raise openerp.exceptions.Warning: if Moneris refused the card
+        """
+        Acquirer = self.pool['payment.acquirer']
+        acquirer = Acquirer._moneris_get_config(cr, uid, acquirer_id)
+        partner = self.pool['res.partner'].browse(cr, uid, partner_id, context=context)
+        access_token = Acquirer._moneris_s2s_get_access_token(cr, uid, [acquirer_id], context=context)[acquirer_id]
+        data = json.dumps({
+            'number': cc_values['number'],
+            'type': cc_values['brand'],
+            'expire_month': cc_values['expiry_mm'],
+            'expire_year': cc_values['expiry_yy'],
+            'cvv2': cc_values['cvc'],
+            'first_name': partner.name,
+            'last_name': partner.name,
+            'external_customer_id': str(partner_id),
+        })
+        request = urllib2.Request('%s/vault/credit-card' % acquirer.api_url, data, {
+            'Content-Type': 'application/json',
+            'Authorization': 'Bearer %s' % access_token,
+        })
+        renew_token = partial(Acquirer._moneris_s2s_renew_access_token, cr, uid, acquirer_id, context=context)
+        result = json.loads(self.pool['payment.transaction']._moneris_try_url(
+            request, tries=3, environment=acquirer.environment, renew_token=renew_token, context=context))
+        if not result.get('id'):
+            _logger.warning('Moneris: could not store a card of partner %s: %s', partner_id, result.get('message'))
+            raise Warning(_('The card could not be saved: %s') % (result.get('message') or _('refused by Moneris')))
+        number = result.get('number') or cc_values['number']
+        return self.create(cr, uid, {
+            'name': 'XXXX-%s' % number[-4:],
+            'partner_id': partner_id,
+            'acquirer_id': acquirer_id,
+            'data_key': result['id'],
+            'card_type': result.get('type') or cc_values['brand'],
+            'expiry': '%s/%s' % (cc_values['expiry_mm'], cc_values['expiry_yy']),
+        }, context=context)
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+import logging
+from datetime import date
+
+from openerp.osv import osv, fields
+from openerp.tools import DEFAULT_SERVER_DATE_FORMAT
+
+from openerp.addons.payment_moneris.models.moneris_callback import LOCK_NAMESPACE
+
+_logger = logging.getLogger(__name__)
+
+# (dbname, partition table) seen committed; a partition created by the
+# current transaction may still be rolled back
+_partitions = set()
+
+
+def _month_start(day, months=0):
+    """ First day of the month ``months`` after (or before) that of ``day``. """
+    month = day.year * 12 + day.month - 1 + months
+    return date(month // 12, month % 12 + 1, 1)
+
+
+class MonerisTxnData(osv.Model):
+    """ Raw verification payload of Moneris transactions, stored as JSON off
+    the ``payment.transaction`` rows, which only keep ``moneris_txn_id``.
+
+    The table is partitioned by month with table inheritance: rows are stored
+    in ``payment_moneris_txn_data_YYYYMM`` children, created on demand, and
+    old months are dropped whole by ``prune_partitions``. Transactions link to
+    their row through ``moneris_data_month``. Rows must therefore be written
+    with ``store``, not ``create``.
+    """
+    _name = 'payment.moneris.txn.data'
+    _description = 'Moneris Transaction Data'
+    _log_access = False
+    _order = 'date desc, id desc'
+
+    _columns = {
+        'transaction_id': fields.many2one('payment.transaction', 'Transaction', required=True,
+                                          ondelete='cascade', readonly=True, select=True),
+        'date': fields.date('Date', required=True, readonly=True),
+        'data': fields.text('Data', readonly=True, help='Verification payload, as JSON'),
+    }
+
+    def _partition_name(self, month):
+        return '%s_%s' % (self._table, month)
+
+    def _partition(self, cr, day):
+        """ Return the month (YYYYMM) of ``day``, creating its partition if
+        needed. """
+        start = _month_start(day)
+        month = start.strftime('%Y%m')
+        name = self._partition_name(month)
+        if (cr.dbname, name) in _partitions:
+            return month
+        # only a partition seen from a new transaction is known to be committed
+        with self.pool.cursor() as probe_cr:
+            probe_cr.execute("SELECT 1 FROM pg_class WHERE relname = %s", (name,))
+            if probe_cr.fetchone():
+                _partitions.add((cr.dbname, name))
+                return month
+        # concurrent callbacks of a new month would race on the creation
+        cr.execute("SELECT pg_advisory_xact_lock(%s, hashtext(%s))", (LOCK_NAMESPACE, name))
+        cr.execute("SELECT 1 FROM pg_class WHERE relname = %s", (name,))
+        if not cr.fetchone():
+            _logger.info('Moneris: creating partition %s', name)
+            # constraints other than CHECK are not inherited
+            cr.execute("""
+                CREATE TABLE %s (
+                    PRIMARY KEY (id),
+                    CHECK (date >= %%s AND date < %%s),
+                    FOREIGN KEY (transaction_id) REFERENCES payment_transaction ON DELETE CASCADE
+                ) INHERITS (%s)
+            """ % (name, self._table), (start.strftime(DEFAULT_SERVER_DATE_FORMAT),
+                                        _month_start(start, 1).strftime(DEFAULT_SERVER_DATE_FORMAT)))
+            cr.execute('CREATE INDEX %s_transaction_id_index ON %s (transaction_id)' % (name, name))
+        return month
+
+    def _get_months(self, cr, tx_ids):
+        """ Return the transactions of ``tx_ids`` having data by partition
+        month, dropping the months whose partition was pruned. """
+        cr.execute("SELECT id, moneris_data_month FROM payment_transaction WHERE id IN %s AND moneris_data_month IS NOT NULL",
+                   (tuple(tx_ids),))
+        months = {}
+        for tx_id, month in cr.fetchall():
+            months.setdefault(month, []).append(tx_id)
+        if months:
+            cr.execute("SELECT relname FROM pg_class WHERE relname IN %s",
+                       (tuple(self._partition_name(month) for month in months),))
+            existing = set(row[0] for row in cr.fetchall())
+            months = dict((month, ids) for month, ids in months.items() if self._partition_name(month) in existing)
+        return months
+
+    def store(self, cr, uid, tx_id, payload, day=None, context=None):
+        """ Store the verification payload of transaction ``tx_id``, replacing
+        the previous one. Nothing is written when it did not change. The month
+        of the partition holding it is kept on the transaction, so that only
+        that partition is ever looked at.
+
+        :return: True if the payload was written
+        """
+        data = json.dumps(payload, sort_keys=True)
+        months = self._get_months(cr, [tx_id])
+        if months:
+            table = self._partition_name(months.keys()[0])
+            cr.execute("SELECT id, data FROM %s WHERE transaction_id = %%s" % table, (tx_id,))
+            row = cr.fetchone()
+            if row:
+                if row[1] == data:
+                    return False
+                cr.execute("UPDATE %s SET data = %%s WHERE id = %%s" % table, (data, row[0]))
+                return True
+        day = day or date.today()
+        month = self._partition(cr, day)
+        cr.execute("INSERT INTO %s (transaction_id, date, data) VALUES (%%s, %%s, %%s)" % self._partition_name(month),
+                   (tx_id, day.strftime(DEFAULT_SERVER_DATE_FORMAT), data))
+        # raw update: no need to go through the ORM for this technical link
+        cr.execute("UPDATE payment_transaction SET moneris_data_month = %s WHERE id = %s", (month, tx_id))
+        return True
+
+    def get_payloads(self, cr, uid, tx_ids, context=None):
+        """ Return the payloads of the given transactions, by transaction id. """
+        if not tx_ids:
+            return {}
+        payloads = {}
+        for month, ids in self._get_months(cr, tx_ids).items():
+            cr.execute("SELECT transaction_id, data FROM %s WHERE transaction_id IN %%s" % self._partition_name(month),
+                       (tuple(ids),))
+            payloads.update((tx_id, json.loads(data or '{}')) for tx_id, data in cr.fetchall())
+        return payloads
+
+    def prune_partitions(self, cr, uid, months=24, context=None):
+        """ Drop the partitions of the months more than ``months`` ago. """
+        limit = _month_start(date.today(), -months).strftime('%Y%m')
+        cr.execute("""
+            SELECT c.relname
+              FROM pg_inherits i
+              JOIN pg_class c ON c.oid = i.inhrelid
+              JOIN pg_class p ON p.oid = i.inhparent
+             WHERE p.relname = %s
+        """, (self._table,))
+        prefix = self._partition_name('')
+        for name, in cr.fetchall():
+            if name[len(prefix):] < limit:
+                _logger.info('Moneris: dropping partition %s', name)
+                cr.execute('DROP TABLE %s' % name)
+                _partitions.discard((cr.dbname, name))
+        return True
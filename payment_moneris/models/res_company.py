@@ -8,28 +8,16 @@ class ResCompany(osv.Model):
 
     def _get_moneris_account(self, cr, uid, ids, name, arg, context=None):
         Acquirer = self.pool['payment.acquirer']
-        company_id = self.pool['res.users'].browse(cr, uid, uid, context=context).company_id.id
-        moneris_ids = Acquirer.search(cr, uid, [
-            ('website_published', '=', True),
-            ('name', 'ilike', 'moneris'),
-            ('company_id', '=', company_id),
-        ], limit=1, context=context)
-        if moneris_ids:
-            moneris = Acquirer.browse(cr, uid, moneris_ids[0], context=context)
-            return dict.fromkeys(ids, moneris.moneris_email_account)
-        return dict.fromkeys(ids, False)
+        res = {}
+        for company_id in ids:
+            res[company_id] = Acquirer._moneris_get_company_acquirer(cr, uid, company_id)[1]
+        return res
 
     def _set_moneris_account(self, cr, uid, id, name, value, arg, context=None):
         Acquirer = self.pool['payment.acquirer']
-        company_id = self.pool['res.users'].browse(cr, uid, uid, context=context).company_id.id
-        moneris_account = self.browse(cr, uid, id, context=context).moneris_account
-        moneris_ids = Acquirer.search(cr, uid, [
-            ('website_published', '=', True),
-            ('moneris_email_account', '=', moneris_account),
-            ('company_id', '=', company_id),
-        ], context=context)
-        if moneris_ids:
-            Acquirer.write(cr, uid, moneris_ids, {'moneris_email_account': value}, context=context)
+        acquirer_id = Acquirer._moneris_get_company_acquirer(cr, uid, id)[0]
+        if acquirer_id:
+            Acquirer.write(cr, uid, [acquirer_id], {'moneris_email_account': value}, context=context)
         return True
 
     _columns = {
@@ -41,3 +29,10 @@ class ResCompany(osv.Model):
             help="Moneris username (usually email) for receiving online payments."
         ),
     }
+
+    def write(self, cr, uid, ids, vals, context=None):
+        res = super(ResCompany, self).write(cr, uid, ids, vals, context=context)
+        if 'country_id' in vals:
+            # the acquirer config snapshots hold the company country (fees)
+            self.pool['payment.acquirer'].clear_caches()
+        return res
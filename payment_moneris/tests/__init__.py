@@ -0,0 +1,4 @@
+# -*- coding: utf-8 -*-
+
+from openerp.addons.payment_moneris.tests import test_moneris_state
+from openerp.addons.payment_moneris.tests import test_moneris_settlement
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+from openerp import fields
+from openerp.tests.common import TransactionCase
+
+
+class TestMonerisSettlement(TransactionCase):
+    """ Incremental settlement summary: logged deltas and their folding. """
+
+    def setUp(self):
+        super(TestMonerisSettlement, self).setUp()
+        self.Transaction = self.registry('payment.transaction')
+        self.Settlement = self.registry('payment.moneris.settlement')
+        self.acquirer_id = self.ref('payment_moneris.payment_acquirer_moneris')
+        self.currency_id = self.ref('base.CAD')
+        self.cr.execute("SELECT COALESCE(max(id), 0) FROM payment_moneris_settlement_delta")
+        self.last_delta_id = self.cr.fetchone()[0]
+
+    def _create_tx(self, reference, **values):
+        tx_id = self.Transaction.create(self.cr, self.uid, dict({
+            'reference': reference,
+            'acquirer_id': self.acquirer_id,
+            'amount': 10.0,
+            'currency_id': self.currency_id,
+            'partner_id': self.ref('base.res_partner_2'),
+            'partner_country_id': self.ref('base.ca'),
+        }, **values))
+        return self.Transaction.browse(self.cr, self.uid, tx_id)
+
+    def _new_deltas(self):
+        self.cr.execute("""
+            SELECT card_type, state, count, amount FROM payment_moneris_settlement_delta
+             WHERE id > %s ORDER BY id
+        """, (self.last_delta_id,))
+        return sorted(self.cr.fetchall())
+
+    def test_cancelled_checkout_paid_later(self):
+        # counted as cancelled without card type, then paid with a Visa card
+        tx = self._create_tx('test_moneris_settlement_cancel', state='cancel')
+        self.assertTrue(self.Transaction._moneris_write_changes(self.cr, self.uid, tx, {
+            'state': 'done',
+            'date_validate': fields.Datetime.now(),
+        }, payload={'Card': 'V', 'result': '1'}))
+        self.assertEqual(self._new_deltas(), [('', 'cancel', -1, -10.0), ('V', 'done', 1, 10.0)])
+
+    def test_refused_change_logs_nothing(self):
+        tx = self._create_tx('test_moneris_settlement_refused', state='error')
+        self.assertFalse(self.Transaction._moneris_write_changes(self.cr, self.uid, tx, {'state': 'done'},
+                                                                 payload={'Card': 'V'}))
+        self.assertEqual(self._new_deltas(), [])
+        self.assertEqual(self.registry('payment.moneris.txn.data').get_payloads(self.cr, self.uid, [tx.id]), {})
+
+    def test_fold_deltas(self):
+        day = fields.Date.today()
+        key = (day, self.acquirer_id, 'TEST', self.currency_id, 'done')
+        self.Settlement._log_deltas(self.cr, {key: [2, 20.0]})
+        self.Settlement._log_deltas(self.cr, {key: [-1, -10.0]})
+        self.Settlement._fold_deltas(self.cr)
+        self.assertEqual(self._new_deltas(), [])
+        self.cr.execute("""
+            SELECT count, amount FROM payment_moneris_settlement
+             WHERE day = %s AND acquirer_id = %s AND card_type = %s AND currency_id = %s AND state = %s
+        """, key)
+        self.assertEqual(self.cr.fetchall(), [(1, 10.0)])
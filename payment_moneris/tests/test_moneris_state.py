@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+import mock
+
+from openerp import fields
+from openerp.tests.common import TransactionCase
+
+
+class TestMonerisState(TransactionCase):
+    """ State machine of the Moneris transactions (``_moneris_write_changes``). """
+
+    def setUp(self):
+        super(TestMonerisState, self).setUp()
+        self.Transaction = self.registry('payment.transaction')
+        self.acquirer_id = self.ref('payment_moneris.payment_acquirer_moneris')
+        self.currency_id = self.ref('base.CAD')
+        self.partner_id = self.ref('base.res_partner_2')
+
+    def _create_tx(self, reference, **values):
+        values = dict({
+            'reference': reference,
+            'acquirer_id': self.acquirer_id,
+            'amount': 10.0,
+            'currency_id': self.currency_id,
+            'partner_id': self.partner_id,
+            'partner_country_id': self.ref('base.ca'),
+        }, **values)
+        tx_id = self.Transaction.create(self.cr, self.uid, values)
+        return self.Transaction.browse(self.cr, self.uid, tx_id)
+
+    def _write(self, tx, values):
+        result = self.Transaction._moneris_write_changes(self.cr, self.uid, tx, values)
+        tx.refresh()
+        return result
+
+    def test_allowed_transitions(self):
+        tx = self._create_tx('test_moneris_allowed')
+        self.assertTrue(self._write(tx, {'state': 'pending'}))
+        self.assertEqual(tx.state, 'pending')
+        now = fields.Datetime.now()
+        self.assertTrue(self._write(tx, {'state': 'done', 'date_validate': now}))
+        self.assertEqual(tx.state, 'done')
+        self.assertEqual(tx.date_validate, now)
+        self.assertTrue(self._write(tx, {'state': 'cancel'}))
+        self.assertEqual(tx.state, 'cancel')
+
+    def test_refused_transitions(self):
+        tx = self._create_tx('test_moneris_refused', state='error')
+        for state in ('draft', 'pending', 'done', 'cancel'):
+            self.assertFalse(self._write(tx, {'state': state}))
+            self.assertEqual(tx.state, 'error')
+        tx = self._create_tx('test_moneris_refused_done', state='done')
+        self.assertFalse(self._write(tx, {'state': 'pending'}))
+        self.assertFalse(self._write(tx, {'state': 'error'}))
+        self.assertEqual(tx.state, 'done')
+
+    def test_cancelled_draft_can_be_paid(self):
+        # an abandoned checkout cancelled before the payment went through
+        tx = self._create_tx('test_moneris_cancel_draft', state='cancel')
+        self.assertFalse(self._write(tx, {'state': 'error'}))
+        self.assertTrue(self._write(tx, {'state': 'done', 'date_validate': fields.Datetime.now()}))
+        self.assertEqual(tx.state, 'done')
+
+    def test_cancelled_payment_stays_cancelled(self):
+        # a validated payment cancelled afterwards must not come back
+        tx = self._create_tx('test_moneris_cancel_done', state='cancel', date_validate=fields.Datetime.now())
+        self.assertFalse(self._write(tx, {'state': 'done'}))
+        self.assertEqual(tx.state, 'cancel')
+
+    def test_no_change(self):
+        tx = self._create_tx('test_moneris_no_change', state='done', acquirer_reference='1234')
+        with mock.patch.object(type(tx), 'write') as write:
+            self.assertTrue(self.Transaction._moneris_write_changes(self.cr, self.uid, tx, {
+                'state': 'done',
+                'acquirer_reference': '1234',
+                'date_validate': fields.Datetime.now(),
+            }))
+            self.assertFalse(write.called)
+
+    def test_only_changes_written(self):
+        tx = self._create_tx('test_moneris_changes', state='pending', acquirer_reference='1234')
+        with mock.patch.object(type(tx), 'write', return_value=True) as write:
+            self.Transaction._moneris_write_changes(self.cr, self.uid, tx, {
+                'state': 'pending',
+                'acquirer_reference': '5678',
+                'date_validate': fields.Datetime.now(),
+            })
+        write.assert_called_once_with({'acquirer_reference': '5678'})